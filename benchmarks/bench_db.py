@@ -0,0 +1,121 @@
+# Сравнение доступа к bot.db до и после пула соединений: сколько соединений открывается
+# на одно обновление и сколько занимает обработка обновления в middleware и хендлере.
+#
+# Запуск: python benchmarks/bench_db.py [--users 1000] [--updates 2000] [--concurrency 50]
+import argparse
+import asyncio
+import datetime
+import os
+import statistics
+import sys
+import tempfile
+import sqlite3
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+DB_ERRORS = (sqlite3.OperationalError,)
+
+
+def load_bot_module(workdir, extra_config=""):
+    with open(os.path.join(workdir, "config.ini"), "w") as f:
+        f.write("[Telegram]\ntoken = 123456:BENCHMARK\n[GigaChat]\ntoken = benchmark\n" + extra_config)
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import main
+    return main
+
+
+class ConnectCounter:
+    def __init__(self, aiosqlite):
+        self.aiosqlite = aiosqlite
+        self.original = aiosqlite.connect
+        self.count = 0
+
+    def __enter__(self):
+        def connect(*args, **kwargs):
+            self.count += 1
+            return self.original(*args, **kwargs)
+        self.aiosqlite.connect = connect
+        return self
+
+    def __exit__(self, *exc):
+        self.aiosqlite.connect = self.original
+
+
+async def legacy_update(aiosqlite, user_id, text):
+    # То, что раньше делали SomeMiddleware и хендлер на каждое сообщение
+    async with aiosqlite.connect('bot.db') as conn:
+        await conn.execute("INSERT INTO logs (user_id, action, text, datetime) VALUES (?, ?, ?, ?)",
+                           (user_id, "send_message", text, datetime.datetime.now()))
+        await conn.commit()
+    async with aiosqlite.connect('bot.db') as conn:
+        cursor = await conn.execute("SELECT * FROM users")
+        await cursor.fetchall()
+    async with aiosqlite.connect('bot.db') as conn:
+        async with conn.execute("SELECT id FROM users WHERE id = ?", (user_id,)) as cursor:
+            await cursor.fetchone()
+    async with aiosqlite.connect('bot.db') as conn:
+        async with conn.execute("SELECT * FROM users WHERE id = (?)", (user_id,)) as cursor:
+            await cursor.fetchall()
+
+
+async def pooled_update(main, user_id, text):
+    await main.logs.add(user_id, "send_message", text, datetime.datetime.now())
+    await main.users.exists(user_id)
+    await main.users.get(user_id)
+
+
+async def run(name, update, args, counter):
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await update(1 + i % args.users, f"message {i}")
+            except DB_ERRORS:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    counter.count = 0
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.updates)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(f"{name:8} connections/update={counter.count / args.updates:5.2f} "
+          f"updates/s={args.updates / elapsed:8.1f} "
+          f"mean={statistics.mean(latencies) * 1000:7.2f}ms "
+          f"p50={latencies[len(latencies) // 2] * 1000:7.2f}ms "
+          f"p99={latencies[int(len(latencies) * 0.99)] * 1000:7.2f}ms "
+          f"errors={errors}")
+
+
+async def bench(main, args):
+    await main.start_db()
+    await main.db.executemany("INSERT INTO users (id, last_name, first_name, current_language, current_level) "
+                              "VALUES (?, ?, ?, ?, ?)",
+                              [(i, "Иванов", "Иван", "en", "A") for i in range(1, args.users + 1)])
+    print(f"users={args.users} updates={args.updates} concurrency={args.concurrency} pool={main.db.pool_size}")
+    with ConnectCounter(main.aiosqlite) as counter:
+        await run("before", lambda user_id, text: legacy_update(main.aiosqlite, user_id, text), args, counter)
+        await run("after", lambda user_id, text: pooled_update(main, user_id, text), args, counter)
+    await main.db.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(bench(load_bot_module(directory), arguments))
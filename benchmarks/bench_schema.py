@@ -0,0 +1,101 @@
+# Время типичных запросов бота на исходной схеме (миграция 1) и после всех миграций
+# для разного числа пользователей. С ключами и индексами время не должно расти вместе с объёмом данных.
+#
+# Запуск: python benchmarks/bench_schema.py [--sizes 1000,10000,100000] [--logs-per-user 100]
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_db import load_bot_module
+
+# Для запросов, которые менялись вместе со схемой, первым идёт вариант для v1, вторым – для последней версии
+QUERIES = {
+    "user by id": [("SELECT id, last_name, first_name, current_language, current_level, reminder "
+                    "FROM users WHERE id = ?", lambda user_id: (user_id,))],
+    "word to review": [("SELECT word, translation FROM words WHERE user_id = ? AND repeat > 0",
+                        lambda user_id: (user_id,)),
+                       ("SELECT word, translation FROM words WHERE user_id = ? AND due <= ? ORDER BY due LIMIT 1",
+                        lambda user_id: (user_id, time.time()))],
+    "word update": [("UPDATE words SET translation = translation WHERE user_id = ? AND word = ?",
+                     lambda user_id: (user_id, f"word{user_id % 7}"))],
+    "user logs for a day": [("SELECT COUNT(*) FROM logs WHERE user_id = ? AND datetime >= ?",
+                             lambda user_id: (user_id, "2026-01-02"))],
+}
+
+
+def seed(path, users, words_per_user, logs_per_user):
+    connection = sqlite3.connect(path)
+    connection.executemany("INSERT INTO users VALUES (?, 'Иванов', 'Иван', 'en', 'A', NULL)",
+                           ((i,) for i in range(1, users + 1)))
+    connection.executemany("INSERT INTO words VALUES (?, ?, 'перевод', 2)",
+                           ((i, f"word{j}") for i in range(1, users + 1) for j in range(words_per_user)))
+    start = datetime.datetime(2026, 1, 1)
+    total = users * logs_per_user
+    connection.executemany("INSERT INTO logs VALUES (?, 'send_message', 'hello', ?)",
+                           ((1 + n % users, str(start + datetime.timedelta(seconds=n * 86400 * 3 // total)))
+                            for n in range(total)))
+    connection.commit()
+    connection.close()
+
+
+def measure(path, users, lookups, latest):
+    connection = sqlite3.connect(path)
+    result = {}
+    for name, variants in QUERIES.items():
+        sql, parameters = variants[-1] if latest else variants[0]
+        timings = []
+        for _ in range(lookups):
+            user_id = random.randint(1, users)
+            started = time.perf_counter()
+            connection.execute(sql, parameters(user_id)).fetchall()
+            timings.append(time.perf_counter() - started)
+        result[name] = statistics.median(timings)
+    connection.rollback()
+    connection.close()
+    return result
+
+
+async def bench(main, args):
+    print(f"{'users':>8} {'log rows':>10} {'schema':>7} " + " ".join(f"{name:>20}" for name in QUERIES))
+    for size in args.sizes:
+        path = f"bench_{size}.db"
+        database = main.Database(path, pool_size=1)
+        await database.open()
+        await database.migrate(main.MIGRATIONS[:1])
+        seed(path, size, args.words_per_user, args.logs_per_user)
+        for schema in ("v1", f"v{len(main.MIGRATIONS)}"):
+            if schema != "v1":
+                started = time.perf_counter()
+                await database.migrate(main.MIGRATIONS)
+                print(f"{'':>8} {'':>10} migration to {schema} took {time.perf_counter() - started:.1f}s")
+            timings = measure(path, size, args.lookups, schema != "v1")
+            print(f"{size:>8} {size * args.logs_per_user:>10} {schema:>7} " +
+                  " ".join(f"{timings[name] * 1000:>18.3f}ms" for name in QUERIES))
+        await database.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(",")],
+                        default=[1000, 10000, 100000])
+    parser.add_argument("--words-per-user", type=int, default=20)
+    parser.add_argument("--logs-per-user", type=int, default=100)
+    parser.add_argument("--lookups", type=int, default=20)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(bench(load_bot_module(directory), arguments))
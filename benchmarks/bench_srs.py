@@ -0,0 +1,67 @@
+# Выбор слова для повторения: старый способ (все слова пользователя в память и случайный выбор)
+# против индексного запроса "ближайшее к повторению слово" и обновления расписания после ответа.
+#
+# Запуск: python benchmarks/bench_srs.py [--users 20] [--words 10000] [--lookups 200]
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_db import load_bot_module
+
+
+async def legacy_pick(main, user_id):
+    rows = await main.db.fetchall("SELECT * FROM words WHERE user_id = ? AND repeat > 0", (user_id,))
+    return rows[random.randint(0, len(rows) - 1)][1] if rows else None
+
+
+async def timed(call, users, lookups):
+    timings = []
+    for _ in range(lookups):
+        user_id = random.randint(1, users)
+        started = time.perf_counter()
+        await call(user_id)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return statistics.mean(timings), timings[int(len(timings) * 0.99)]
+
+
+async def bench(main, args):
+    await main.start_db()
+    now = time.time()
+    rows = ((user_id, f"word{i}", "перевод", 2, now + random.uniform(-7, 30) * 24 * 3600)
+            for user_id in range(1, args.users + 1) for i in range(args.words))
+    await main.db.executemany("INSERT INTO words (user_id, word, translation, repeat, due) VALUES (?, ?, ?, ?, ?)",
+                              rows)
+    print(f"users={args.users} words/user={args.words} lookups={args.lookups}")
+
+    async def review(user_id):
+        pair = await main.words.next_due(user_id)
+        if pair is not None:
+            await main.words.review(user_id, pair[0], 5)
+
+    for name, call in (("legacy random pick", lambda user_id: legacy_pick(main, user_id)),
+                       ("next due word", main.words.next_due),
+                       ("next due + review", review)):
+        mean, p99 = await timed(call, args.users, args.lookups)
+        print(f"{name:20} mean={mean * 1000:8.3f}ms p99={p99 * 1000:8.3f}ms")
+    await main.db.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--words", type=int, default=10000)
+    parser.add_argument("--lookups", type=int, default=200)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(bench(load_bot_module(directory), arguments))
@@ -0,0 +1,286 @@
+# Нагрузочный тест всего бота без Telegram и GigaChat: синтетические обновления от тысяч пользователей
+# прогоняются через настоящий dp (middleware, FSM, хендлеры, база, outbox, шлюз к модели).
+# Вместо Telegram – сессия бота с заданной задержкой, вместо GigaChat – модель с заданной задержкой.
+#
+# Каждый пользователь проходит регистрацию, выбор языка и уровня, изучение и повторение слов с ответом
+# на перевод, тему по грамматике, свободный чат и смену языка через /choose. Отчёт: обновлений в секунду,
+# p50/p99 по шагам, запросов к базе на обновление, запаздывание event loop, вызовы Telegram и модели.
+#
+# Запуск: python benchmarks/loadtest.py [--users 1000] [--concurrency 200] [--llm-latency 0.5]
+#         [--tg-latency 0.02] [--chat 2] [--save result.json] [--baseline result.json]
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Message, Update
+from langchain_core.messages import AIMessage
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_db import load_bot_module
+
+# Лимиты Telegram в outbox и ограничения частоты для пользователей снимаются, чтобы мерить сам бот,
+# а не токен-бакеты (--rate-limits их оставляет)
+UNLIMITED = ("[Outbox]\nrate = 1000000\nchat_rate = 1000000\nchat_burst = 1000000\nworkers = 64\n"
+             "[Throttling]\nrate = 1000000\nburst = 1000000\ndebounce = 0\n")
+
+
+class MockSession(BaseSession):
+    # Сессия бота, которая никуда не ходит: отвечает через latency секунд и запоминает отправленное
+    def __init__(self, latency=0.02):
+        super().__init__()
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+        self.calls = Counter()
+        self.last_text = {}
+
+    async def make_request(self, bot, method, timeout=None):
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        name = type(method).__name__
+        self.calls[name] += 1
+        if name in ("SendMessage", "EditMessageText"):
+            self.last_text[method.chat_id] = method.text
+            return Message.model_validate({"message_id": getattr(method, "message_id", None)
+                                           or next(self.message_ids),
+                                           "date": int(time.time()),
+                                           "chat": {"id": method.chat_id, "type": "private"},
+                                           "text": method.text})
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        # Файлы в сценарии не скачиваются: поток пустой
+        for chunk in ():
+            yield chunk
+
+    async def close(self):
+        pass
+
+
+class FakeChatModel:
+    # Замена GigaChat: отвечает в формате, который ждут хендлеры, через latency секунд (±50%)
+    model = "loadtest"
+
+    def __init__(self, latency=0.5, chunk_size=20):
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.counter = itertools.count(1)
+        self.translations = {}
+        self.calls = Counter()
+
+    def answer(self, prompt: str) -> str:
+        if "новых слов" in prompt:
+            self.calls["words"] += 1
+            count = int(prompt.split("Предложи ", 1)[1].split(" ", 1)[0])
+            lines = []
+            for _ in range(count):
+                # Цифры в словах парсер отбрасывает, поэтому номер кодируется буквами
+                n, suffix = next(self.counter), ""
+                while n:
+                    n, digit = divmod(n, 26)
+                    suffix += chr(ord("a") + digit)
+                self.translations["word" + suffix] = "слово " + suffix
+                lines.append(f"word{suffix} - слово {suffix}")
+            return "\n".join(lines)
+        if "по грамматике" in prompt:
+            self.calls["topics"] += 1
+            return f"Тема: Grammar topic {next(self.counter)}\n" + "Объяснение темы. " * 40
+        if "Да или Нет" in prompt:
+            self.calls["checks"] += 1
+            return random.choice(("Да", "Нет"))
+        if "Конспект" in prompt:
+            self.calls["summaries"] += 1
+            return "Ученик спрашивал про грамматику и новые слова."
+        self.calls["chat"] += 1
+        return "Хороший вопрос! " * 25
+
+    async def ainvoke(self, messages):
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        return AIMessage(content=self.answer(messages[-1].content))
+
+    async def astream(self, messages):
+        text = self.answer(messages[-1].content)
+        chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+        delay = random.uniform(0.5, 1.5) * self.latency / len(chunks)
+        for chunk in chunks:
+            await asyncio.sleep(delay)
+            yield AIMessage(content=chunk)
+
+
+class Simulation:
+    def __init__(self, main, session: MockSession, model: FakeChatModel, args):
+        self.main = main
+        self.session = session
+        self.model = model
+        self.args = args
+        self.update_ids = itertools.count(1)
+        self.timings = defaultdict(list)
+        self.errors = 0
+
+    def user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": "Иван", "last_name": f"Иванов{user_id}"}
+
+    async def feed(self, step, payload):
+        update = Update.model_validate({"update_id": next(self.update_ids), **payload})
+        started = time.perf_counter()
+        try:
+            await self.main.dp.feed_update(self.main.bot, update)
+        except Exception:
+            self.errors += 1
+        self.timings[step].append(time.perf_counter() - started)
+
+    async def message(self, step, user_id, text):
+        await self.feed(step, {"message": {"message_id": next(self.update_ids), "date": int(time.time()),
+                                           "chat": {"id": user_id, "type": "private"},
+                                           "from": self.user(user_id), "text": text}})
+
+    async def callback(self, step, user_id, data):
+        await self.feed(step, {"callback_query": {"id": str(next(self.update_ids)), "from": self.user(user_id),
+                                                  "chat_instance": str(user_id), "data": data}})
+
+    async def script(self, user_id):
+        main = self.main
+        await self.message("start", user_id, "/start")
+        await self.message("name", user_id, f"Иванов{user_id} Иван")
+        await self.message("language", user_id, random.choice(list(main.LANGUAGES.values())))
+        await self.message("level", user_id, random.choice(list(main.LEVELS.values())))
+        for _ in range(2):
+            await self.callback("study_words", user_id, "study_words")
+        # Слова становятся доступны для повторения через LEARNING_STEP, поэтому срок сдвигается вручную
+        await main.db.execute("UPDATE words SET due = 0 WHERE user_id = ?", (user_id,))
+        await self.callback("review", user_id, "study_words")
+        prompt = self.session.last_text.get(user_id, "")
+        if prompt.startswith("Давайте повторим слово "):
+            word = prompt.split("Давайте повторим слово ", 1)[1].split("\n", 1)[0]
+            answer = self.model.translations.get(word, "") if random.random() < 0.5 else "что-то другое"
+            await self.message("translate", user_id, answer or "что-то другое")
+        await self.callback("exit", user_id, "exit")
+        await self.callback("study_topics", user_id, "study_topics")
+        for _ in range(self.args.chat):
+            # Часть вопросов повторяется у разных пользователей, как типичные вопросы в жизни
+            await self.message("chat", user_id, f"Как сказать «вопрос номер {random.randint(1, 100)}»?")
+        # Смена языка через /choose проходит тот же выбор языка и уровня, что и после регистрации
+        await self.message("choose", user_id, "/choose")
+        await self.message("language", user_id, random.choice(list(main.LANGUAGES.values())))
+        await self.message("level", user_id, random.choice(list(main.LEVELS.values())))
+        await self.message("menu", user_id, "/menu")
+
+
+async def monitor_loop(lags, interval=0.01):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+async def bench(main, args):
+    session = MockSession(args.tg_latency)
+    model = FakeChatModel(args.llm_latency)
+    main.bot.session = session
+    # Строка в лог на каждое обновление сама по себе заметно тормозит прогон
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+    main.gateway.model = model
+    main.setup_dispatcher(leader=False)
+    for start in (main.start_db, main.start_logs, main.start_outbox, main.start_llm):
+        await start()
+    simulation = Simulation(main, session, model, args)
+    lags = []
+    monitor = asyncio.create_task(monitor_loop(lags))
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run(user_id):
+        async with semaphore:
+            await simulation.script(user_id)
+
+    queries = main.db.stats["queries"]
+    started = time.perf_counter()
+    await asyncio.gather(*(run(user_id) for user_id in range(1, args.users + 1)))
+    elapsed = time.perf_counter() - started
+    queries = main.db.stats["queries"] - queries
+    monitor.cancel()
+    await main.stop_services()
+
+    updates = sum(len(timings) for timings in simulation.timings.values())
+    result = {
+        "users": args.users,
+        "updates": updates,
+        "errors": simulation.errors,
+        "seconds": elapsed,
+        "updates_per_sec": updates / elapsed,
+        "p50_ms": percentile([t for ts in simulation.timings.values() for t in ts], 0.5) * 1000,
+        "p99_ms": percentile([t for ts in simulation.timings.values() for t in ts], 0.99) * 1000,
+        "db_ops_per_update": queries / updates,
+        "loop_lag_p99_ms": percentile(lags, 0.99) * 1000,
+        "loop_lag_max_ms": max(lags, default=0.0) * 1000,
+        "steps": {step: {"count": len(timings),
+                         "p50_ms": percentile(timings, 0.5) * 1000,
+                         "p99_ms": percentile(timings, 0.99) * 1000}
+                  for step, timings in simulation.timings.items()},
+        "telegram_calls": dict(session.calls),
+        "llm_calls": dict(model.calls),
+    }
+    report(result, load_baseline(args.baseline))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+def load_baseline(path):
+    if not path:
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def delta(value, base):
+    if base is None:
+        return ""
+    return f" ({(value - base) / base * 100:+.1f}%)" if base else f" (было {base:.2f})"
+
+
+def report(result, baseline=None):
+    base = baseline or {}
+    print(f"users={result['users']} updates={result['updates']} errors={result['errors']} "
+          f"time={result['seconds']:.1f}s")
+    for key in ("updates_per_sec", "p50_ms", "p99_ms", "db_ops_per_update", "loop_lag_p99_ms", "loop_lag_max_ms"):
+        print(f"{key:18} {result[key]:10.2f}{delta(result[key], base.get(key))}")
+    print(f"{'step':14} {'count':>7} {'p50 ms':>10} {'p99 ms':>10}")
+    for step, stats in result["steps"].items():
+        base_step = base.get("steps", {}).get(step, {})
+        print(f"{step:14} {stats['count']:7d} {stats['p50_ms']:10.2f} {stats['p99_ms']:10.2f}"
+              f"{delta(stats['p99_ms'], base_step.get('p99_ms'))}")
+    print("telegram:", ", ".join(f"{name}={count}" for name, count in sorted(result["telegram_calls"].items())))
+    print("llm:", ", ".join(f"{name}={count}" for name, count in sorted(result["llm_calls"].items())))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=200, help="сколько пользователей активны одновременно")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="средняя задержка ответа модели, секунды")
+    parser.add_argument("--tg-latency", type=float, default=0.02, help="средняя задержка Bot API, секунды")
+    parser.add_argument("--chat", type=int, default=2, help="сообщений в свободный чат на пользователя")
+    parser.add_argument("--rate-limits", action="store_true", help="оставить лимиты Telegram в outbox")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="сохранить результат в JSON")
+    parser.add_argument("--baseline", help="сравнить с сохранённым результатом")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    random.seed(arguments.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(bench(load_bot_module(directory, "" if arguments.rate_limits else UNLIMITED), arguments))
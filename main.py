@@ -4,7 +4,7 @@ import logging
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
 from aiogram import Router, F
 from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.types import Message
@@ -18,19 +18,34 @@ from aiogram.utils.chat_action import ChatActionSender
 from aiogram.types import ReplyKeyboardRemove
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from typing import Any, Awaitable, Callable, Dict
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Tuple
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject
+from aiogram.exceptions import (TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter,
+                                TelegramServerError)
 from html import escape
 import asyncio
 import aiosqlite
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_SUBMITTED
 import requests
 import uuid
+import hashlib
+import gzip
+import os
+import json
+import re
 import datetime
-from langchain_core.messages import HumanMessage, SystemMessage
+from zoneinfo import ZoneInfo
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 from langchain_gigachat.chat_models import GigaChat
-from random import randint
+from collections import deque, OrderedDict
+import time
+from contextlib import aclosing, asynccontextmanager, contextmanager
+import contextvars
+import multiprocessing
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 config = configparser.ConfigParser()
 config.read("config.ini")
@@ -56,11 +71,22 @@ LEVELS = {"0": "Новичок A0",
           "B": "Продвинутый B1-B2",
           "C": "Профессиональный C1"}
 
+TIMEZONE = ZoneInfo("Europe/Moscow")
+
+SERVER_MODE = config.get("Server", "mode", fallback="polling")
+DROP_PENDING_UPDATES = config.getboolean("Server", "drop_pending_updates", fallback=False)
+WEBHOOK_URL = config.get("Server", "webhook_url", fallback="").rstrip("/")
+WEBHOOK_PATH = config.get("Server", "webhook_path", fallback="/webhook")
+WEBHOOK_SECRET = config.get("Server", "webhook_secret", fallback="")
+HOST = config.get("Server", "host", fallback="0.0.0.0")
+PORT = config.getint("Server", "port", fallback=8080)
+WORKERS = config.getint("Server", "workers", fallback=1)
+SHUTDOWN_TIMEOUT = config.getfloat("Server", "shutdown_timeout", fallback=30)
+
 logging.basicConfig(force=True, level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 bot = Bot(token=TG_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
 
 
 class Form(StatesGroup):
@@ -81,6 +107,1826 @@ class Keyboard:
     menu_keyboard = InlineKeyboardMarkup(inline_keyboard=[[menu_button_1, menu_button_2], [menu_button_3]])
 
 
+class Metrics:
+    # Счётчики и гистограммы в памяти процесса, отдаются по HTTP в текстовом формате Prometheus.
+    # Статистика компонентов (stats) подключается через collect и выводится как есть.
+    # Если включена трассировка, каждое измерение внутри обновления попадает и в его трассу.
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, host="127.0.0.1", port=9100):
+        self.host = host
+        self.port = port
+        self.counters: Dict[tuple, float] = {}
+        self.histograms: Dict[tuple, list] = {}
+        self.collectors: Dict[str, Callable[[], Mapping[str, Any]]] = {}
+        self.trace: contextvars.ContextVar = contextvars.ContextVar("trace", default=None)
+        self.runner = None
+
+    def inc(self, name: str, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+        spans = self.trace.get()
+        if spans is not None:
+            spans.append((name, labels, seconds))
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def collect(self, component: str, stats: Callable[[], Mapping[str, Any]]):
+        self.collectors[component] = stats
+
+    @staticmethod
+    def labels(pairs) -> str:
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                              for k, v in pairs) + "}"
+
+    def render(self) -> str:
+        lines = []
+        for (name, pairs), value in sorted(self.counters.items()):
+            lines.append(f"{name}{self.labels(pairs)} {value}")
+        for (name, pairs), (buckets, total, count) in sorted(self.histograms.items()):
+            for bound, hits in zip(self.BUCKETS, buckets):
+                lines.append(f"{name}_bucket{self.labels(pairs + (('le', bound),))} {hits}")
+            lines.append(f"{name}_bucket{self.labels(pairs + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{self.labels(pairs)} {total}")
+            lines.append(f"{name}_count{self.labels(pairs)} {count}")
+        for component, stats in self.collectors.items():
+            try:
+                values = stats()
+            except Exception:
+                logger.exception("Metrics collector %s failed", component)
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)):
+                    lines.append(f"bot_{component}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def start(self):
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info("Metrics are served on http://%s:%d/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+METRICS = config.getboolean("Metrics", "enabled", fallback=False)
+TRACE_THRESHOLD = config.getfloat("Metrics", "trace_threshold", fallback=0)
+metrics = Metrics(host=config.get("Metrics", "host", fallback="127.0.0.1"),
+                  port=config.getint("Metrics", "port", fallback=9100))
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    @property
+    def full(self) -> bool:
+        return self.delay() == 0.0 and self.tokens >= self.capacity
+
+
+class LLMUnavailable(Exception):
+    # Запрос к модели отклонён без обращения к GigaChat: у пользователя уже есть незавершённые запросы
+    # или исчерпан общий бюджет запросов в минуту
+    BUSY = "busy"
+    BUDGET = "budget"
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def llm_error_text(error: Exception, default="Сервис временно недоступен, попробуйте позже") -> str:
+    if isinstance(error, LLMUnavailable):
+        if error.reason == LLMUnavailable.BUSY:
+            return "Подождите, я ещё отвечаю на предыдущий вопрос"
+        return "Сейчас слишком много запросов, попробуйте через минуту"
+    return default
+
+
+class LLMGateway:
+    # Все обращения к GigaChat идут через пул воркеров: не больше concurrency запросов одновременно,
+    # очередь каждого пользователя обслуживается по кругу, чтобы один пользователь не занимал все слоты.
+    # Фоновые запросы (слова, темы) не привязаны к пользователю и не ограничиваются user_limit
+    BACKGROUND_USER = 0
+
+    def __init__(self, model, concurrency=4, timeout=60.0, queue_timeout=120.0, stream_timeout=180.0,
+                 user_limit=2, budget=0):
+        self.model = model
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.stream_timeout = stream_timeout
+        self.queues: Dict[int, deque] = {}
+        self.order = deque()
+        self.condition = asyncio.Condition()
+        self.workers = []
+        self.closing = False
+        self.in_flight = 0
+        # Не больше user_limit незавершённых запросов на пользователя и budget запросов в минуту на всех
+        self.user_limit = user_limit
+        self.budget = TokenBucket(budget / 60, budget) if budget > 0 else None
+        self.outstanding: Dict[int, int] = {}
+        self.stats = {"requests": 0, "completed": 0, "failed": 0, "timeouts": 0, "max_queue_depth": 0,
+                      "rejected_busy": 0, "rejected_budget": 0}
+
+    @property
+    def queue_depth(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def start(self):
+        if not self.workers:
+            self.closing = False
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self, timeout=10.0):
+        # Отмена может потеряться, если запрос к модели завершился в тот же момент, поэтому воркеры
+        # ещё и проверяют closing, а ожидание ограничено timeout
+        async with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.cancel()
+        if self.workers:
+            _, pending = await asyncio.wait(self.workers, timeout=timeout)
+            if pending:
+                logger.warning("%d LLM workers did not stop in time", len(pending))
+        self.workers = []
+        for queue in self.queues.values():
+            for _, _, future, _, _ in queue:
+                if not future.done():
+                    future.cancel()
+        self.queues.clear()
+        self.order.clear()
+
+    async def invoke(self, user_id, messages):
+        return await self._submit(user_id, lambda: self.model.ainvoke(messages), self.timeout)
+
+    async def stream(self, user_id, messages):
+        # Ответ модели по частям; запрос занимает слот пула, пока поток не закончится
+        chunks = asyncio.Queue()
+
+        async def pump():
+            async for chunk in self.model.astream(messages):
+                chunks.put_nowait(chunk.content)
+            chunks.put_nowait(None)
+
+        task = asyncio.ensure_future(self._submit(user_id, pump, self.stream_timeout))
+        try:
+            while True:
+                getter = asyncio.ensure_future(chunks.get())
+                await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    getter.cancel()
+                    task.result()
+                    continue
+                chunk = getter.result()
+                if chunk is None:
+                    break
+                yield chunk
+            await task
+        finally:
+            if not task.done():
+                task.cancel()
+
+    async def _submit(self, user_id, call, timeout):
+        if self.user_limit and user_id != self.BACKGROUND_USER \
+                and self.outstanding.get(user_id, 0) >= self.user_limit:
+            self.stats["rejected_busy"] += 1
+            raise LLMUnavailable(LLMUnavailable.BUSY)
+        if self.budget is not None:
+            if self.budget.delay() > 0:
+                self.stats["rejected_budget"] += 1
+                raise LLMUnavailable(LLMUnavailable.BUDGET)
+            self.budget.consume()
+        self.outstanding[user_id] = self.outstanding.get(user_id, 0) + 1
+        try:
+            return await self._enqueue(user_id, call, timeout)
+        finally:
+            self.outstanding[user_id] -= 1
+            if not self.outstanding[user_id]:
+                del self.outstanding[user_id]
+
+    async def _enqueue(self, user_id, call, timeout):
+        future = asyncio.get_running_loop().create_future()
+        async with self.condition:
+            if user_id not in self.queues:
+                self.queues[user_id] = deque()
+                self.order.append(user_id)
+            # Контекст вызывающего нужен, чтобы время очереди и запроса попало в трассу его обновления
+            self.queues[user_id].append((call, timeout, future, time.perf_counter(), contextvars.copy_context()))
+            self.stats["requests"] += 1
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self.queue_depth)
+            self.condition.notify()
+        try:
+            return await asyncio.wait_for(future, self.queue_timeout + timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise
+
+    async def _next(self):
+        async with self.condition:
+            while not self.order:
+                if self.closing:
+                    return None
+                await self.condition.wait()
+            user_id = self.order.popleft()
+            queue = self.queues[user_id]
+            item = queue.popleft()
+            if queue:
+                self.order.append(user_id)
+            else:
+                del self.queues[user_id]
+            return item
+
+    async def _worker(self):
+        while not self.closing:
+            item = await self._next()
+            if item is None:
+                return
+            call, timeout, future, queued, context = item
+            if future.done():
+                continue
+            started = time.perf_counter()
+            context.run(metrics.observe, "bot_llm_queue_seconds", started - queued)
+            self.in_flight += 1
+            outcome = "ok"
+            task = asyncio.ensure_future(call())
+            # Если вызывающий перестал ждать (закрыл поток, отменён), запрос к модели прерывается и освобождает слот
+            future.add_done_callback(lambda _: task.cancel() if future.cancelled() else None)
+            try:
+                async with asyncio.timeout(timeout):
+                    result = await task
+            except asyncio.CancelledError:
+                outcome = "cancelled"
+                task.cancel()
+                if not future.done():
+                    future.cancel()
+                # Отменён сам воркер (остановка шлюза), а не только запрос
+                if asyncio.current_task().cancelling():
+                    raise
+            except Exception as e:
+                outcome = "timeout" if isinstance(e, asyncio.TimeoutError) else "error"
+                self.stats["failed"] += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.stats["completed"] += 1
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.in_flight -= 1
+                context.run(metrics.observe, "bot_llm_call_seconds", time.perf_counter() - started,
+                            outcome=outcome)
+
+
+gateway = LLMGateway(llm,
+                     concurrency=config.getint("LLM", "concurrency", fallback=4),
+                     timeout=config.getfloat("LLM", "timeout", fallback=60),
+                     queue_timeout=config.getfloat("LLM", "queue_timeout", fallback=120),
+                     stream_timeout=config.getfloat("LLM", "stream_timeout", fallback=180),
+                     user_limit=config.getint("LLM", "user_limit", fallback=2),
+                     budget=config.getint("LLM", "budget", fallback=0))
+STREAMING = config.getboolean("LLM", "streaming", fallback=True)
+
+
+class Outbox:
+    # Все исходящие сообщения проходят через очередь с приоритетами: ответы пользователям раньше рассылок.
+    # Общий лимит Telegram и лимит на один чат соблюдаются токен-бакетами, RetryAfter и сетевые ошибки
+    # повторяются автоматически. Сообщения одного чата отправляются строго по порядку.
+    INTERACTIVE = 0
+    BROADCAST = 1
+
+    def __init__(self, bot: Bot, rate=30, chat_rate=1.0, chat_burst=3, workers=8, max_retries=3):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers_count = workers
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate, rate)
+        self.chats: Dict[int, TokenBucket] = {}
+        self.pending: Dict[int, deque] = {}
+        self.queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self.sequence = 0
+        self.workers = []
+        self.stats = {"sent": 0, "retried": 0, "failed": 0, "throttled": 0}
+
+    async def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+
+    async def stop(self, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def send(self, chat_id: int, text: str, priority=INTERACTIVE, **kwargs) -> Message:
+        return await self.call(self.bot.send_message, priority, chat_id=chat_id, text=text, **kwargs)
+
+    async def call(self, method, priority=INTERACTIVE, **kwargs):
+        chat_id = kwargs["chat_id"]
+        future = asyncio.get_running_loop().create_future()
+        item = [priority, chat_id, method, kwargs, future, 0]
+        queue = self.pending.get(chat_id)
+        if queue is None:
+            self.pending[chat_id] = deque([item])
+            self._put(item)
+        else:
+            queue.append(item)
+        return await future
+
+    def _put(self, item):
+        self.sequence += 1
+        self.queue.put_nowait((item[0], self.sequence, item))
+
+    def _put_later(self, delay, item):
+        asyncio.get_running_loop().call_later(delay, self._put, item)
+
+    def _done(self, chat_id: int):
+        queue = self.pending[chat_id]
+        queue.popleft()
+        if queue:
+            self._put(queue[0])
+        else:
+            del self.pending[chat_id]
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) > 10000:
+                self.chats = {key: value for key, value in self.chats.items() if not value.full}
+            bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            _, _, item = await self.queue.get()
+            _, chat_id, method, kwargs, future, attempt = item
+            if future.done():
+                self._done(chat_id)
+                continue
+            chat_bucket = self._chat_bucket(chat_id)
+            delay = chat_bucket.delay()
+            if delay > 0:
+                self.stats["throttled"] += 1
+                self._put_later(delay, item)
+                continue
+            while (delay := self.bucket.delay()) > 0:
+                await asyncio.sleep(delay)
+            chat_bucket.consume()
+            self.bucket.consume()
+            try:
+                result = await method(**kwargs)
+            except TelegramRetryAfter as e:
+                self.stats["retried"] += 1
+                self._put_later(e.retry_after, item)
+                continue
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt < self.max_retries:
+                    self.stats["retried"] += 1
+                    item[5] = attempt + 1
+                    self._put_later(2 ** attempt, item)
+                    continue
+                self.stats["failed"] += 1
+                if not future.done():
+                    future.set_exception(e)
+            except Exception as e:
+                self.stats["failed"] += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.stats["sent"] += 1
+                if not future.done():
+                    future.set_result(result)
+            self._done(chat_id)
+
+
+outbox = Outbox(bot,
+                rate=config.getint("Outbox", "rate", fallback=30),
+                chat_rate=config.getfloat("Outbox", "chat_rate", fallback=1.0),
+                chat_burst=config.getint("Outbox", "chat_burst", fallback=3),
+                workers=config.getint("Outbox", "workers", fallback=8))
+
+
+class Database:
+    # Долгоживущий пул соединений с bot.db вместо aiosqlite.connect на каждый запрос.
+    # auto_vacuum должен идти до journal_mode: переключение в WAL уже создаёт файл новой базы.
+    # На существующую базу он не действует, её переводит enable_incremental_vacuum.
+    PRAGMAS = ("PRAGMA auto_vacuum = INCREMENTAL",
+               "PRAGMA journal_mode = WAL",
+               "PRAGMA synchronous = NORMAL",
+               "PRAGMA temp_store = MEMORY",
+               "PRAGMA cache_size = -16000",
+               "PRAGMA mmap_size = 67108864",
+               "PRAGMA busy_timeout = 5000")
+    TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", re.IGNORECASE)
+
+    def __init__(self, path, pool_size=4):
+        self.path = path
+        self.pool_size = pool_size
+        self.pool: asyncio.Queue = asyncio.Queue()
+        self.connections = []
+        self.stats = {"connections": 0, "queries": 0}
+
+    async def open(self):
+        if self.connections:
+            return
+        for _ in range(self.pool_size):
+            connection = await aiosqlite.connect(self.path)
+            for pragma in self.PRAGMAS:
+                await connection.execute(pragma)
+            self.connections.append(connection)
+            self.pool.put_nowait(connection)
+            self.stats["connections"] += 1
+
+    async def close(self):
+        for connection in self.connections:
+            await connection.execute("PRAGMA optimize")
+            await connection.close()
+        self.connections = []
+        self.pool = asyncio.Queue()
+
+    async def migrate(self, migrations):
+        async with self.connection() as connection:
+            async with connection.execute("PRAGMA user_version") as cursor:
+                version = (await cursor.fetchone())[0]
+            for number, script in enumerate(migrations[version:], start=version + 1):
+                logger.info("Applying database migration %d", number)
+                try:
+                    await connection.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;")
+                except Exception:
+                    await connection.rollback()
+                    raise
+
+    async def enable_incremental_vacuum(self):
+        # Режим применяется к уже созданной базе только полным VACUUM. Он держит блокировку записи
+        # всё время работы, поэтому выполняется один раз при запуске, до приёма обновлений.
+        async with self.connection() as connection:
+            async with connection.execute("PRAGMA auto_vacuum") as cursor:
+                if (await cursor.fetchone())[0] == 2:
+                    return
+            logger.info("Switching database to incremental auto_vacuum")
+            await connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            await connection.execute("VACUUM")
+
+    @asynccontextmanager
+    async def connection(self):
+        connection = await self.pool.get()
+        try:
+            yield connection
+        finally:
+            self.pool.put_nowait(connection)
+
+    @asynccontextmanager
+    async def transaction(self):
+        async with self.connection() as connection:
+            try:
+                yield connection
+            except BaseException:
+                await connection.rollback()
+                raise
+            await connection.commit()
+
+    def timer(self, op: str, sql: str):
+        # Время запроса вместе с ожиданием свободного соединения, в разрезе операции и таблицы
+        self.stats["queries"] += 1
+        match = self.TABLE_RE.search(sql)
+        return metrics.timer("bot_db_query_seconds", op=op, table=match.group(1) if match else "")
+
+    async def execute(self, sql, parameters=()):
+        with self.timer("execute", sql):
+            async with self.transaction() as connection:
+                cursor = await connection.execute(sql, parameters)
+                return cursor.rowcount
+
+    async def executemany(self, sql, rows):
+        with self.timer("executemany", sql):
+            async with self.transaction() as connection:
+                await connection.executemany(sql, rows)
+
+    async def fetchone(self, sql, parameters=()):
+        with self.timer("fetchone", sql):
+            async with self.connection() as connection:
+                async with connection.execute(sql, parameters) as cursor:
+                    return await cursor.fetchone()
+
+    async def fetchall(self, sql, parameters=()):
+        with self.timer("fetchall", sql):
+            async with self.connection() as connection:
+                async with connection.execute(sql, parameters) as cursor:
+                    return await cursor.fetchall()
+
+
+class UserProfile:
+    __slots__ = ("id", "last_name", "first_name", "current_language", "current_level", "reminder")
+
+    def __init__(self, id, last_name, first_name, current_language, current_level, reminder):
+        self.id = id
+        self.last_name = last_name
+        self.first_name = first_name
+        self.current_language = current_language
+        self.current_level = current_level
+        self.reminder = reminder
+
+
+class UserCache:
+    # LRU-кэш профилей с временем жизни записи. Репозиторий обновляет его при каждой записи в users.
+    def __init__(self, max_size=10000, ttl=600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, user_id: int) -> Optional[UserProfile]:
+        entry = self.entries.get(user_id)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self.entries[user_id]
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(user_id)
+        self.stats["hits"] += 1
+        return entry[0]
+
+    def put(self, profile: UserProfile):
+        self.entries[profile.id] = (profile, time.monotonic() + self.ttl)
+        self.entries.move_to_end(profile.id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def update(self, user_id: int, **fields):
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            for name, value in fields.items():
+                setattr(entry[0], name, value)
+
+    def invalidate(self, user_id: int):
+        self.entries.pop(user_id, None)
+
+
+class UserRepository:
+    def __init__(self, db: Database, cache: UserCache):
+        self.db = db
+        self.cache = cache
+
+    async def exists(self, user_id: int) -> bool:
+        return await self.get(user_id) is not None
+
+    async def get(self, user_id: int) -> Optional[UserProfile]:
+        profile = self.cache.get(user_id)
+        if profile is not None:
+            return profile
+        row = await self.db.fetchone("SELECT id, last_name, first_name, current_language, current_level, reminder "
+                                     "FROM users WHERE id = ?", (user_id,))
+        if row is None:
+            return None
+        profile = UserProfile(*row)
+        self.cache.put(profile)
+        return profile
+
+    async def create(self, user_id: int, last_name: str, first_name: str):
+        created = await self.db.execute("INSERT OR IGNORE INTO users (id, last_name, first_name) VALUES (?, ?, ?)",
+                                        (user_id, last_name, first_name))
+        if created:
+            self.cache.put(UserProfile(user_id, last_name, first_name, None, None, None))
+
+    async def set_language(self, user_id: int, language: str):
+        # При смене языка словарь пользователя сбрасывается
+        try:
+            async with self.db.transaction() as connection:
+                await connection.execute("UPDATE users SET current_language = ? WHERE id = ?", (language, user_id))
+                await connection.execute("DELETE FROM words WHERE user_id = ?", (user_id,))
+        except Exception:
+            self.cache.invalidate(user_id)
+            raise
+        self.cache.update(user_id, current_language=language)
+
+    async def set_level(self, user_id: int, level: str):
+        await self._update(user_id, "current_level", level)
+
+    async def set_reminder(self, user_id: int, reminder: Optional[int]):
+        await self._update(user_id, "reminder", reminder)
+
+    async def _update(self, user_id: int, column: str, value):
+        try:
+            await self.db.execute(f"UPDATE users SET {column} = ? WHERE id = ?", (value, user_id))
+        except Exception:
+            self.cache.invalidate(user_id)
+            raise
+        self.cache.update(user_id, **{column: value})
+
+    async def list_reminders(self) -> List[Tuple[int, int, Optional[str]]]:
+        return await self.db.fetchall("SELECT id, reminder, reminder_sent FROM users WHERE reminder IS NOT NULL")
+
+    async def reminder_sent(self, user_id: int) -> Optional[str]:
+        row = await self.db.fetchone("SELECT reminder_sent FROM users WHERE id = ?", (user_id,))
+        return row[0] if row is not None else None
+
+    async def mark_reminders_sent(self, user_ids: List[int], date: datetime.date):
+        await self.db.executemany("UPDATE users SET reminder_sent = ? WHERE id = ?",
+                                  [(date.isoformat(), user_id) for user_id in user_ids])
+
+
+class ReminderScheduler:
+    # Индекс напоминаний по часам: раз в час рассылка идёт только по пользователям этого часа,
+    # которым сегодня ещё не писали. Индекс строится из базы при старте и обновляется из хендлеров.
+    def __init__(self, repository: UserRepository):
+        self.repository = repository
+        self.buckets: Dict[int, set] = {hour: set() for hour in range(24)}
+        self.hours: Dict[int, int] = {}
+        self.last_sent: Dict[int, datetime.date] = {}
+        self.task = None
+        self.sending = set()
+        # Если напоминания меняют другие процессы, индекс перечитывается перед каждой рассылкой
+        self.reload = False
+
+    async def load(self):
+        for bucket in self.buckets.values():
+            bucket.clear()
+        self.hours.clear()
+        self.last_sent.clear()
+        for user_id, hour, sent in await self.repository.list_reminders():
+            if 0 <= hour <= 23:
+                self.buckets[hour].add(user_id)
+                self.hours[user_id] = hour
+            if sent:
+                self.last_sent[user_id] = datetime.date.fromisoformat(sent)
+
+    async def set(self, user_id: int, hour: Optional[int]):
+        await self.repository.set_reminder(user_id, hour)
+        old_hour = self.hours.pop(user_id, None)
+        if old_hour is not None:
+            self.buckets[old_hour].discard(user_id)
+        if hour is not None:
+            self.buckets[hour].add(user_id)
+            self.hours[user_id] = hour
+            now = datetime.datetime.now(TIMEZONE)
+            if hour == now.hour:
+                # Рассылка этого часа уже могла пройти, поэтому напоминание уходит сразу,
+                # если сегодня пользователю ещё не писали
+                if self.reload:
+                    sent = await self.repository.reminder_sent(user_id)
+                    if sent:
+                        self.last_sent[user_id] = datetime.date.fromisoformat(sent)
+                if self.last_sent.get(user_id) != now.date():
+                    self.last_sent[user_id] = now.date()
+                    task = asyncio.create_task(self._deliver([user_id], now))
+                    self.sending.add(task)
+                    task.add_done_callback(self.sending.discard)
+
+    def due(self, now: datetime.datetime) -> List[int]:
+        today = now.date()
+        return [user_id for user_id in self.buckets[now.hour] if self.last_sent.get(user_id) != today]
+
+    async def dispatch(self):
+        if self.reload:
+            await self.load()
+        now = datetime.datetime.now(TIMEZONE)
+        due = self.due(now)
+        if not due:
+            return
+        for user_id in due:
+            self.last_sent[user_id] = now.date()
+        await self._deliver(due, now)
+
+    async def _deliver(self, due: List[int], now: datetime.datetime):
+        results = await asyncio.gather(*(self._send(user_id) for user_id in due))
+        sent = [user_id for user_id, ok in zip(due, results) if ok]
+        await self.repository.mark_reminders_sent(sent, now.date())
+        logger.info("Sent %d of %d reminders for %d:00", len(sent), len(due), now.hour)
+
+    async def _send(self, user_id: int) -> bool:
+        try:
+            await outbox.send(user_id, '⏰ Пора изучать новые слова', priority=Outbox.BROADCAST)
+            return True
+        except TelegramForbiddenError:
+            # Пользователь заблокировал бота, напоминания ему больше не нужны
+            await self.set(user_id, None)
+        except Exception:
+            logger.exception("Failed to send reminder to %s", user_id)
+            self.last_sent.pop(user_id, None)
+        return False
+
+
+class SpacedRepetition:
+    # Интервальное повторение по SM-2: после каждого ответа пересчитываются лёгкость слова,
+    # интервал до следующего повторения в днях и время, когда слово снова станет доступно.
+    INITIAL_EASE = 2.5
+    MIN_EASE = 1.3
+    LEARNING_STEP = 10 * 60
+
+    @staticmethod
+    def quality(attempts: int) -> int:
+        # 5 – сразу правильно, 3 – со второй попытки, 2 – с третьей и дальше (слово считается забытым)
+        return 5 if attempts == 0 else 3 if attempts == 1 else 2
+
+    @classmethod
+    def schedule(cls, ease: float, interval: float, reps: int, quality: int, now: float):
+        ease = max(cls.MIN_EASE, ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+        if quality < 3:
+            return ease, 0.0, 0, now + cls.LEARNING_STEP
+        reps += 1
+        interval = 1.0 if reps == 1 else 6.0 if reps == 2 else round(interval * ease, 1)
+        return ease, interval, reps, now + interval * 24 * 3600
+
+
+class WordRepository:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def next_due(self, user_id: int, now: Optional[float] = None) -> Optional[Tuple[str, str]]:
+        return await self.db.fetchone("SELECT word, translation FROM words WHERE user_id = ? AND due <= ? "
+                                      "ORDER BY due LIMIT 1", (user_id, time.time() if now is None else now))
+
+    async def add(self, user_id: int, word: str, translation: str):
+        due = time.time() + SpacedRepetition.LEARNING_STEP
+        await self.db.execute("INSERT INTO words (user_id, word, translation, due, ease, interval_days, reps) "
+                              "VALUES (?, ?, ?, ?, ?, 0, 0) ON CONFLICT (user_id, word) DO UPDATE "
+                              "SET translation = excluded.translation, due = excluded.due, ease = excluded.ease, "
+                              "interval_days = 0, reps = 0",
+                              (user_id, word, translation, due, SpacedRepetition.INITIAL_EASE))
+
+    async def review(self, user_id: int, word: str, quality: int):
+        async with self.db.transaction() as connection:
+            async with connection.execute("SELECT ease, interval_days, reps FROM words WHERE user_id = ? AND word = ?",
+                                          (user_id, word)) as cursor:
+                row = await cursor.fetchone()
+            if row is None:
+                return
+            ease, interval, reps, due = SpacedRepetition.schedule(*row, quality, time.time())
+            await connection.execute("UPDATE words SET ease = ?, interval_days = ?, reps = ?, due = ? "
+                                     "WHERE user_id = ? AND word = ?", (ease, interval, reps, due, user_id, word))
+
+    async def get_translation(self, user_id: int, word: str) -> Optional[str]:
+        row = await self.db.fetchone("SELECT translation FROM words WHERE user_id = ? AND word = ?", (user_id, word))
+        return row[0] if row is not None else None
+
+    async def has(self, user_id: int, word: str) -> bool:
+        return await self.db.fetchone("SELECT 1 FROM words WHERE user_id = ? AND word = ?",
+                                      (user_id, word)) is not None
+
+    async def count(self, user_id: int) -> int:
+        return (await self.db.fetchone("SELECT COUNT(*) FROM words WHERE user_id = ?", (user_id,)))[0]
+
+
+class WordPrefetcher:
+    # Новые слова запрашиваются у GigaChat пачками заранее и хранятся в буфере на каждую пару (язык, уровень).
+    # Пользователю выдаётся первое слово из буфера, которого ещё нет в его словаре.
+    # Тире считается разделителем, только если вокруг него пробелы: дефис внутри слова (peut-être, e-mail)
+    # остаётся частью слова
+    WORD_RE = re.compile(r"^\s*(?:\d+[.)]\s*|[-•*]\s+)?\(?\s*([^,:()]+?)(?:\s+[-–—]\s+|\s*[,:]\s*)([^()]+?)\s*\)?\s*$")
+    MARKUP = "*_`\"'«» "
+    BACKGROUND_USER = LLMGateway.BACKGROUND_USER
+
+    def __init__(self, gateway: LLMGateway, repository: "WordRepository", batch_size=20, low_watermark=5,
+                 max_attempts=3, backoff=1.0):
+        self.gateway = gateway
+        self.repository = repository
+        self.batch_size = batch_size
+        self.low_watermark = low_watermark
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.buffers: Dict[Tuple[str, str], deque] = {}
+        self.recent: Dict[Tuple[str, str], deque] = {}
+        self.refills: Dict[Tuple[str, str], asyncio.Task] = {}
+        self.stats = {"served": 0, "skipped_known": 0, "refills": 0, "refill_failures": 0, "empty": 0}
+
+    async def pop(self, user_id: int, language: str, level: str) -> Optional[Tuple[str, str]]:
+        key = (language, level)
+        pair = await self._take(user_id, key)
+        if pair is None:
+            await self.ensure(language, level, force=True)
+            pair = await self._take(user_id, key)
+        if pair is None:
+            self.stats["empty"] += 1
+            return None
+        self.stats["served"] += 1
+        self.recent.setdefault(key, deque(maxlen=100)).append(pair[0])
+        self.ensure(language, level)
+        return pair
+
+    async def _take(self, user_id: int, key: Tuple[str, str]) -> Optional[Tuple[str, str]]:
+        buffer = self.buffers.setdefault(key, deque())
+        for _ in range(len(buffer)):
+            pair = buffer.popleft()
+            if not await self.repository.has(user_id, pair[0]):
+                return pair
+            # Слово уже знакомо этому пользователю, но может пригодиться другим
+            self.stats["skipped_known"] += 1
+            buffer.append(pair)
+        return None
+
+    def ensure(self, language: str, level: str, force=False) -> asyncio.Task:
+        key = (language, level)
+        task = self.refills.get(key)
+        if task is None or task.done():
+            task = self.refills[key] = asyncio.create_task(self._refill(key, force))
+        return task
+
+    async def _refill(self, key: Tuple[str, str], force=False):
+        language, level = key
+        buffer = self.buffers.setdefault(key, deque())
+        if len(buffer) >= self.low_watermark and not force:
+            return
+        exclude = ", ".join(list(self.recent.get(key, ()))[-50:] + [word for word, _ in buffer])
+        messages = [SystemMessage(content=f"Ты бот-репетитор по {LANGUAGES[language]}, с тобой занимается "
+                                          f"пользователь уровня {LEVELS[level]}, ты помогаешь пользователю "
+                                          f"изучать язык."),
+                    HumanMessage(content=f"Предложи {self.batch_size} новых слов для изучения. Каждое слово на "
+                                         f"отдельной строке в формате: слово - перевод этого слова на русский. "
+                                         f"Не пиши ничего лишнего."
+                                         + (f" Не используй слова: {exclude}." if exclude else ""))]
+        for attempt in range(self.max_attempts):
+            try:
+                res = await self.gateway.invoke(self.BACKGROUND_USER, messages)
+                pairs = self.parse(res.content)
+            except LLMUnavailable as e:
+                logger.warning("Word prefetch for %s/%s skipped: %s", language, level, e.reason)
+                pairs = []
+            except Exception:
+                logger.exception("Word prefetch for %s/%s failed", language, level)
+                pairs = []
+            known = {word for word, _ in buffer}
+            pairs = [pair for pair in pairs if pair[0] not in known]
+            if pairs:
+                buffer.extend(pairs)
+                self.stats["refills"] += 1
+                return
+            if attempt + 1 < self.max_attempts:
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+        self.stats["refill_failures"] += 1
+
+    @classmethod
+    def parse(cls, content: str) -> List[Tuple[str, str]]:
+        pairs = []
+        for line in content.splitlines():
+            match = cls.WORD_RE.match(line.strip())
+            if match is None:
+                continue
+            word, translation = match.group(1).strip(cls.MARKUP), match.group(2).strip(cls.MARKUP).rstrip(".")
+            if word and translation and len(word) <= 40 and len(translation) <= 60 \
+                    and not any(char.isdigit() for char in word):
+                pairs.append((word, translation))
+        return pairs
+
+
+class AnswerMatcher:
+    # Проверка перевода без обращения к GigaChat. Точные совпадения и опечатки в длинных словах засчитываются сразу,
+    # явно неверные ответы отклоняются, а всё остальное (например, синонимы) отдаётся на проверку модели.
+    CORRECT = "correct"
+    WRONG = "wrong"
+    UNSURE = "unsure"
+    ARTICLES = {"a", "an", "the", "to", "le", "la", "les", "l", "un", "une", "des", "du", "de", "il", "lo", "i",
+                "gli", "uno", "una", "der", "die", "das", "den", "dem", "ein", "eine", "einen", "el", "los", "las"}
+    SEPARATORS = re.compile(r"[,;/]|\s+или\s+|\s+or\s+")
+    CYRILLIC = re.compile(r"[а-я]")
+
+    def __init__(self):
+        self.stats = {"correct": 0, "wrong": 0, "escalated": 0}
+
+    @classmethod
+    def normalize(cls, text: str) -> str:
+        text = text.lower().replace("ё", "е")
+        text = re.sub(r"[^\w\s]|_", " ", text)
+        return " ".join(word for word in text.split() if word not in cls.ARTICLES)
+
+    @classmethod
+    def variants(cls, text: str) -> List[str]:
+        variants = set()
+        for part in cls.SEPARATORS.split(text):
+            for variant in (re.sub(r"\(.*?\)", " ", part), part):
+                variant = cls.normalize(variant)
+                if variant:
+                    variants.add(variant)
+        return list(variants)
+
+    @staticmethod
+    def distance(first: str, second: str, limit: int) -> int:
+        if abs(len(first) - len(second)) > limit:
+            return limit + 1
+        previous = list(range(len(second) + 1))
+        for i, first_char in enumerate(first, 1):
+            current = [i]
+            for j, second_char in enumerate(second, 1):
+                current.append(min(previous[j] + 1, current[j - 1] + 1,
+                                   previous[j - 1] + (first_char != second_char)))
+            if min(current) > limit:
+                return limit + 1
+            previous = current
+        return previous[-1]
+
+    @staticmethod
+    def tolerance(text: str) -> int:
+        # В коротких словах одна буква часто даёт другое слово (ночь – дочь, петь – пить),
+        # поэтому опечатки прощаются только в длинных, а близкие ответы уходят на проверку модели
+        return 0 if len(text) < 8 else 1 if len(text) < 12 else 2
+
+    def match(self, answer: str, word: str, translation: str) -> str:
+        verdict = self._match(answer, word, translation)
+        self.stats["escalated" if verdict == self.UNSURE else verdict] += 1
+        return verdict
+
+    def _match(self, answer: str, word: str, translation: str) -> str:
+        # На варианты делится только сохранённый перевод. Ответ проверяется целиком: список догадок
+        # через запятую или «или» не засчитывается сразу, его оценивает модель
+        answers = list({self.normalize(re.sub(r"\(.*?\)", " ", answer)), self.normalize(answer)} - {""})
+        if not answers:
+            return self.WRONG
+        if self.SEPARATORS.search(answer):
+            return self.UNSURE
+        accepted = self.variants(translation)
+        for candidate in answers:
+            for variant in accepted:
+                if self.distance(candidate, variant, self.tolerance(variant)) <= self.tolerance(variant):
+                    return self.CORRECT
+        if set(answers) & set(self.variants(word)):
+            return self.WRONG
+        if accepted and all(self.CYRILLIC.search(variant) for variant in accepted) \
+                and not any(self.CYRILLIC.search(candidate) for candidate in answers):
+            return self.WRONG
+        return self.UNSURE
+
+
+class TopicRepository:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def next_unseen(self, user_id: int, language: str, level: str) -> Optional[Tuple[str, str]]:
+        return await self.db.fetchone("SELECT topic, content FROM topics AS t WHERE language = ? AND level = ? "
+                                      "AND NOT EXISTS (SELECT 1 FROM topics_seen AS s WHERE s.user_id = ? "
+                                      "AND s.language = t.language AND s.level = t.level AND s.topic = t.topic) "
+                                      "ORDER BY created LIMIT 1", (language, level, user_id))
+
+    async def mark_seen(self, user_id: int, language: str, level: str, topic: str):
+        async with self.db.transaction() as connection:
+            await connection.execute("INSERT OR IGNORE INTO topics_seen (user_id, language, level, topic) "
+                                     "VALUES (?, ?, ?, ?)", (user_id, language, level, topic))
+            await connection.execute("UPDATE topics SET last_used = ? WHERE language = ? AND level = ? AND topic = ?",
+                                     (time.time(), language, level, topic))
+
+    async def titles(self, language: str, level: str) -> List[str]:
+        rows = await self.db.fetchall("SELECT topic FROM topics WHERE language = ? AND level = ?", (language, level))
+        return [row[0] for row in rows]
+
+    async def add(self, language: str, level: str, topic: str, content: str, max_size: int):
+        now = time.time()
+        async with self.db.transaction() as connection:
+            await connection.execute("INSERT OR REPLACE INTO topics (language, level, topic, content, created, "
+                                     "last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                                     (language, level, topic, content, now, now))
+            # Сверх лимита удаляются темы, которые дольше всего никому не показывались, вместе с отметками
+            # о просмотре, иначе topics_seen рос бы без ограничений
+            async with connection.execute("SELECT topic FROM topics WHERE language = ? AND level = ? "
+                                          "ORDER BY last_used DESC LIMIT -1 OFFSET ?",
+                                          (language, level, max_size)) as cursor:
+                evicted = [(language, level, row[0]) for row in await cursor.fetchall()]
+            if evicted:
+                await connection.executemany("DELETE FROM topics WHERE language = ? AND level = ? AND topic = ?",
+                                             evicted)
+                await connection.executemany("DELETE FROM topics_seen WHERE language = ? AND level = ? "
+                                             "AND topic = ?", evicted)
+
+
+class TopicLibrary:
+    # Объяснения грамматических тем хранятся в базе по (язык, уровень, тема) и переиспользуются всеми
+    # пользователями: каждому показывается тема, которую он ещё не видел. Новые темы генерируются,
+    # только когда непросмотренных не осталось, и заранее в фоне, пока библиотека меньше min_size.
+    TITLE_RE = re.compile(r"^[#*\s]*(?:тема\s*[:\-–—]\s*)?(.+?)[*\s]*$", re.IGNORECASE)
+
+    def __init__(self, gateway: LLMGateway, repository: TopicRepository, min_size=10, max_size=50):
+        self.gateway = gateway
+        self.repository = repository
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        # Если модель повторяет уже известные темы, библиотека не растёт: число генераций за одно
+        # наполнение ограничено
+        self.max_generations = 2 * self.min_size
+        self.generations: Dict[Tuple[str, str], asyncio.Task] = {}
+        # Одна генерация на пару (язык, уровень) в каждый момент: её ждут и промахи пользователей, и фоновое
+        # наполнение, поэтому одновременные промахи не запрашивают модель дважды
+        self.current: Dict[Tuple[str, str], asyncio.Task] = {}
+        self.stats = {"hits": 0, "generated": 0, "failures": 0}
+
+    async def get(self, user_id: int, language: str, level: str) -> str:
+        row = await self.repository.next_unseen(user_id, language, level)
+        if row is None:
+            # Ждём только ближайшую генерацию, а не всё фоновое наполнение; если её тему пользователь
+            # уже успел увидеть, нужна ещё одна
+            for _ in range(2):
+                await asyncio.shield(self._shared_generation(language, level, user_id))
+                row = await self.repository.next_unseen(user_id, language, level)
+                if row is not None:
+                    break
+            else:
+                raise LookupError(f"No topic for {language}/{level}")
+        else:
+            self.stats["hits"] += 1
+        topic, content = row
+        await self.repository.mark_seen(user_id, language, level, topic)
+        self.refresh(language, level)
+        return content
+
+    def refresh(self, language: str, level: str):
+        key = (language, level)
+        if key not in self.generations:
+            self.generations[key] = asyncio.create_task(self._fill(language, level))
+
+    def _shared_generation(self, language: str, level: str, user_id: int) -> asyncio.Task:
+        key = (language, level)
+        task = self.current.get(key)
+        if task is None or task.done():
+            task = self.current[key] = asyncio.ensure_future(self._generate(language, level, user_id))
+            task.add_done_callback(lambda done: self.current.pop(key) if self.current.get(key) is done else None)
+            # Ошибку получают ждущие; если их не осталось, она не должна попасть в лог как неполученная
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        return task
+
+    async def _fill(self, language: str, level: str):
+        try:
+            attempts = 0
+            while len(await self.repository.titles(language, level)) < self.min_size:
+                if attempts >= self.max_generations:
+                    logger.warning("Topic prefill for %s/%s stopped after %d generations", language, level, attempts)
+                    break
+                attempts += 1
+                await asyncio.shield(self._shared_generation(language, level, WordPrefetcher.BACKGROUND_USER))
+        except LLMUnavailable as e:
+            logger.warning("Topic prefill for %s/%s skipped: %s", language, level, e.reason)
+        except Exception:
+            logger.exception("Topic prefill for %s/%s failed", language, level)
+        finally:
+            self.generations.pop((language, level), None)
+
+    async def _generate(self, language: str, level: str, user_id: int):
+        titles = await self.repository.titles(language, level)
+        messages = [SystemMessage(content=f"Ты бот-репетитор по {LANGUAGES[language]}, с тобой занимается "
+                                          f"пользователь уровня {LEVELS[level]}, ты помогаешь пользователю "
+                                          f"изучать язык."),
+                    HumanMessage(content="Нужно доступно объяснить любую тему по грамматике. Первой строкой напиши "
+                                         "название темы в формате «Тема: название», дальше объяснение."
+                                         + (f" Не бери темы: {', '.join(titles)}." if titles else ""))]
+        try:
+            res = await self.gateway.invoke(user_id, messages)
+        except Exception:
+            self.stats["failures"] += 1
+            raise
+        first_line = res.content.strip().split("\n", 1)[0]
+        topic = self.TITLE_RE.match(first_line).group(1)[:100] if first_line.strip() else res.content[:100]
+        await self.repository.add(language, level, topic, res.content, self.max_size)
+        self.stats["generated"] += 1
+
+
+class ResponseCache:
+    # Кэш ответов модели по содержимому запроса: ключ – хэш модели и всех сообщений промпта.
+    # Недавние ответы держатся в памяти, все – в базе с временем жизни ttl и ограничением max_rows.
+    # Одинаковые запросы, пришедшие одновременно, ждут один общий вызов GigaChat.
+    def __init__(self, db: Database, gateway: LLMGateway, max_size=1000, max_rows=50000, ttl=7 * 24 * 3600):
+        self.db = db
+        self.gateway = gateway
+        self.max_size = max_size
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.in_flight: Dict[str, asyncio.Future] = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "stale_hits": 0, "evicted": 0, "saved_seconds": 0.0}
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+    def key(self, messages: list) -> str:
+        payload = [getattr(self.gateway.model, "model", "")] + [(message.type, message.content) for message in messages]
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode()).hexdigest()
+
+    async def invoke(self, user_id: int, messages: list) -> AIMessage:
+        key = self.key(messages)
+        content = await self._lookup(key)
+        if content is not None:
+            return AIMessage(content=content)
+        task = self.in_flight.get(key)
+        shared = task is not None
+        if shared:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            task = asyncio.ensure_future(self._call(key, user_id, messages))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+            task.add_done_callback(self._done)
+        try:
+            try:
+                content = await asyncio.shield(task)
+            except LLMUnavailable as e:
+                # Лимит незавершённых запросов исчерпан у того, кто начал общий вызов, а не у этого пользователя
+                if not shared or e.reason != LLMUnavailable.BUSY:
+                    raise
+                content = await self._call(key, user_id, messages)
+        except LLMUnavailable:
+            # Модель сейчас недоступна по лимитам – лучше устаревший ответ, чем никакого
+            content = await self._stale(key)
+            if content is None:
+                raise
+        return AIMessage(content=content)
+
+    async def stream(self, user_id: int, messages: list):
+        # Ответ из кэша отдаётся одним куском, иначе поток идёт от модели и сохраняется по завершении
+        key = self.key(messages)
+        content = await self._lookup(key)
+        if content is None and key in self.in_flight:
+            self.stats["coalesced"] += 1
+            try:
+                content = await asyncio.shield(self.in_flight[key])
+            except LLMUnavailable as e:
+                # Чужой лимит незавершённых запросов не касается этого пользователя: запрос идёт от его имени
+                if e.reason != LLMUnavailable.BUSY:
+                    raise
+        if content is not None:
+            yield content
+            return
+        self.stats["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        started = time.monotonic()
+        answer = ""
+        try:
+            async with aclosing(self.gateway.stream(user_id, messages)) as chunks:
+                async for chunk in chunks:
+                    answer += chunk
+                    yield chunk
+            await self._store(key, answer, time.monotonic() - started)
+            future.set_result(answer)
+        except LLMUnavailable as e:
+            content = await self._stale(key)
+            if content is None:
+                future.set_exception(e)
+                raise
+            future.set_result(content)
+            yield content
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            if not future.done():
+                future.set_exception(RuntimeError("LLM stream was interrupted"))
+            self.in_flight.pop(key, None)
+            self._done(future)
+
+    async def purge(self):
+        await self.db.execute("DELETE FROM llm_cache WHERE created <= ?", (time.time() - self.ttl,))
+        evicted = await self.db.execute("DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache "
+                                        "ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.max_rows,))
+        self.stats["evicted"] += max(evicted, 0)
+
+    async def _lookup(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] > time.time():
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            self.stats["saved_seconds"] += entry[2]
+            return entry[0]
+        row = await self.db.fetchone("SELECT response, created, latency FROM llm_cache WHERE key = ?", (key,))
+        if row is None or row[1] + self.ttl <= time.time():
+            return None
+        await self.db.execute("UPDATE llm_cache SET used = ? WHERE key = ?", (time.time(), key))
+        self._remember(key, row[0], row[1] + self.ttl, row[2])
+        self.stats["hits"] += 1
+        self.stats["saved_seconds"] += row[2]
+        return row[0]
+
+    async def _stale(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            content = entry[0]
+        else:
+            row = await self.db.fetchone("SELECT response FROM llm_cache WHERE key = ?", (key,))
+            if row is None:
+                return None
+            content = row[0]
+        self.stats["stale_hits"] += 1
+        return content
+
+    async def _call(self, key: str, user_id: int, messages: list) -> str:
+        started = time.monotonic()
+        res = await self.gateway.invoke(user_id, messages)
+        await self._store(key, res.content, time.monotonic() - started)
+        return res.content
+
+    async def _store(self, key: str, content: str, latency: float):
+        if not content.strip():
+            return
+        now = time.time()
+        await self.db.execute("INSERT OR REPLACE INTO llm_cache (key, response, created, used, latency) "
+                              "VALUES (?, ?, ?, ?, ?)", (key, content, now, now, latency))
+        self._remember(key, content, now + self.ttl, latency)
+
+    @staticmethod
+    def _done(future: asyncio.Future):
+        # Ждущих запрос может уже не быть, ошибку всё равно считаем полученной
+        if not future.cancelled():
+            future.exception()
+
+    def _remember(self, key: str, content: str, expires: float, latency: float):
+        self.entries[key] = (content, expires, latency)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+class Conversation:
+    __slots__ = ("user_id", "summary", "turns", "pending", "cleared")
+
+    def __init__(self, user_id: int, summary: str, turns: List[Tuple[str, str]]):
+        self.user_id = user_id
+        self.summary = summary
+        self.turns = deque(turns)
+        self.pending: List[Tuple[str, str]] = []
+        self.cleared = False
+
+
+class ConversationMemory:
+    # Память свободного диалога: последние max_turns реплик хранятся целиком, более старые сворачиваются
+    # моделью в краткий конспект. Промпт собирается так, чтобы уложиться в token_budget.
+    # Диалоги хранятся в базе, в памяти держатся только недавно активные пользователи.
+    def __init__(self, db: Database, gateway: LLMGateway, max_turns=8, token_budget=1500, summary_tokens=300,
+                 cache_size=1000, ttl=30 * 24 * 3600):
+        self.db = db
+        self.gateway = gateway
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.cache: OrderedDict = OrderedDict()
+        self.summaries: Dict[int, asyncio.Task] = {}
+        self.stats = {"summaries": 0, "trimmed_turns": 0}
+
+    @staticmethod
+    def tokens(text: str) -> int:
+        # Грубая оценка без обращения к API: в среднем около трёх символов на токен
+        return len(text) // 3 + 1
+
+    async def get(self, user_id: int) -> Conversation:
+        conversation = self.cache.get(user_id)
+        if conversation is None:
+            row = await self.db.fetchone("SELECT summary, turns FROM conversations WHERE user_id = ?", (user_id,))
+            turns = [tuple(turn) for turn in json.loads(row[1])] if row is not None else []
+            conversation = Conversation(user_id, row[0] if row is not None else "", turns)
+            if self.cache_size <= 0:
+                return conversation
+            self.cache[user_id] = conversation
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache.move_to_end(user_id)
+        return conversation
+
+    def build(self, conversation: Conversation, system: str, question: str) -> list:
+        budget = self.token_budget - self.tokens(system) - self.tokens(question)
+        if conversation.summary:
+            system += f"\n\nКратко о предыдущем разговоре: {conversation.summary}"
+            budget -= self.tokens(conversation.summary)
+        history = []
+        for role, text in reversed(conversation.turns):
+            budget -= self.tokens(text)
+            if budget < 0:
+                self.stats["trimmed_turns"] += 1
+                break
+            history.append(HumanMessage(content=text) if role == "user" else AIMessage(content=text))
+        return [SystemMessage(content=system), *reversed(history), HumanMessage(content=question)]
+
+    async def add(self, user_id: int, question: str, answer: str):
+        conversation = await self.get(user_id)
+        conversation.turns.extend((("user", question), ("assistant", answer)))
+        while len(conversation.turns) > self.max_turns:
+            conversation.pending.append(conversation.turns.popleft())
+        await self._save(conversation)
+        if conversation.pending and user_id not in self.summaries:
+            self.summaries[user_id] = asyncio.create_task(self._summarize(conversation))
+
+    async def clear(self, user_id: int):
+        # Незаконченный конспект иначе сохранил бы старый диалог обратно уже после удаления
+        conversation = self.cache.pop(user_id, None)
+        if conversation is not None:
+            conversation.cleared = True
+        task = self.summaries.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await self.db.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+
+    async def purge(self):
+        await self.db.execute("DELETE FROM conversations WHERE updated <= ?", (time.time() - self.ttl,))
+
+    async def _save(self, conversation: Conversation):
+        if conversation.cleared:
+            return
+        await self.db.execute("INSERT INTO conversations (user_id, summary, turns, updated) VALUES (?, ?, ?, ?) "
+                              "ON CONFLICT (user_id) DO UPDATE "
+                              "SET summary = excluded.summary, turns = excluded.turns, updated = excluded.updated",
+                              (conversation.user_id, conversation.summary,
+                               json.dumps(list(conversation.turns), ensure_ascii=False), time.time()))
+
+    async def _summarize(self, conversation: Conversation):
+        try:
+            while conversation.pending:
+                pending, conversation.pending = conversation.pending, []
+                dialogue = "\n".join(f"{'Пользователь' if role == 'user' else 'Репетитор'}: {text}"
+                                     for role, text in pending)
+                messages = [HumanMessage(content=f"Конспект разговора репетитора с учеником: "
+                                                 f"{conversation.summary or 'пока пусто'}\n\nНовые реплики:\n"
+                                                 f"{dialogue}\n\nОбнови конспект с учётом новых реплик. Пиши "
+                                                 f"кратко, не больше {self.summary_tokens * 2} символов, только "
+                                                 f"сам конспект.")]
+                try:
+                    # Конспект – фоновый запрос и не занимает лимит незавершённых запросов пользователя
+                    res = await self.gateway.invoke(LLMGateway.BACKGROUND_USER, messages)
+                except Exception as e:
+                    # Реплики возвращаются в диалог и сворачиваются после следующего сообщения
+                    conversation.turns.extendleft(reversed(pending + conversation.pending))
+                    conversation.pending = []
+                    if isinstance(e, LLMUnavailable):
+                        logger.warning("Conversation summary for %s postponed: %s", conversation.user_id, e.reason)
+                    else:
+                        logger.exception("Conversation summary for %s failed", conversation.user_id)
+                    break
+                conversation.summary = res.content.strip()[:self.summary_tokens * 3]
+                self.stats["summaries"] += 1
+            await self._save(conversation)
+        except Exception:
+            logger.exception("Conversation summary for %s failed", conversation.user_id)
+        finally:
+            if self.summaries.get(conversation.user_id) is asyncio.current_task():
+                del self.summaries[conversation.user_id]
+
+
+class LogRepository:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def add(self, user_id: int, action: str, text: str, date: datetime.datetime):
+        await self.db.execute("INSERT INTO logs (user_id, action, text, datetime) VALUES (?, ?, ?, ?)",
+                              (user_id, action, text, date))
+
+    async def add_many(self, rows: List[Tuple[int, str, str, datetime.datetime]]):
+        await self.db.executemany("INSERT INTO logs (user_id, action, text, datetime) VALUES (?, ?, ?, ?)", rows)
+
+
+class LogWriter:
+    # Записи логов копятся в памяти и пишутся в базу пачками, вне обработки сообщения.
+    # Если база не успевает и буфер переполнен, новые записи отбрасываются и учитываются в stats["dropped"].
+    def __init__(self, repository: LogRepository, batch_size=200, flush_interval=1.0, max_pending=20000):
+        self.repository = repository
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.buffer = deque()
+        self.ready = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = None
+        self.closing = False
+        self.stats = {"written": 0, "dropped": 0, "batches": 0, "errors": 0}
+
+    def write(self, user_id: int, action: str, text: str, date: datetime.datetime):
+        if len(self.buffer) >= self.max_pending:
+            self.stats["dropped"] += 1
+            return
+        self.buffer.append((user_id, action, text, date))
+        if len(self.buffer) >= self.batch_size:
+            self.ready.set()
+
+    def start(self):
+        if self.task is None:
+            self.closing = False
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout=10.0):
+        if self.task is not None:
+            # Цикл записи завершается сам после очередного flush: отмена посреди записи потеряла бы пачку
+            self.closing = True
+            self.ready.set()
+            _, pending = await asyncio.wait({self.task}, timeout=timeout)
+            if pending:
+                logger.warning("Log writer did not stop in time")
+                self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            while self.buffer:
+                batch = [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+                try:
+                    await self.repository.add_many(batch)
+                except Exception:
+                    logger.exception("Failed to write %d log rows", len(batch))
+                    self.stats["errors"] += 1
+                    room = self.max_pending - len(self.buffer)
+                    self.stats["dropped"] += max(0, len(batch) - room)
+                    self.buffer.extendleft(reversed(batch[:max(0, room)]))
+                    return
+                self.stats["written"] += len(batch)
+                self.stats["batches"] += 1
+
+    async def _run(self):
+        while not self.closing:
+            try:
+                async with asyncio.timeout(self.flush_interval):
+                    await self.ready.wait()
+            except TimeoutError:
+                pass
+            self.ready.clear()
+            await self.flush()
+
+
+class LogMaintenance:
+    # Жизненный цикл таблицы logs. Сырые записи сворачиваются в activity_daily по пользователю и дню (UTC),
+    # до какой записи свёртка дошла, хранится в maintenance. Записи старше retention_days, уже учтённые
+    # в свёртке, выгружаются в gzip-архивы в archive_dir и удаляются, освободившиеся страницы базы
+    # возвращаются через incremental_vacuum.
+    def __init__(self, db: Database, archive_dir="logs_archive", retention_days=90, batch_size=50000,
+                 vacuum_pages=5000):
+        self.db = db
+        self.archive_dir = archive_dir
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.lock = asyncio.Lock()
+        self.stats = {"rolled_up": 0, "archived": 0, "vacuumed_pages": 0, "errors": 0}
+
+    async def watermark(self) -> int:
+        row = await self.db.fetchone("SELECT value FROM maintenance WHERE key = 'logs_rollup'")
+        return row[0] if row is not None else 0
+
+    async def rollup(self) -> int:
+        total = 0
+        async with self.lock:
+            while True:
+                start = await self.watermark()
+                end, count = await self.db.fetchone("SELECT MAX(id), COUNT(*) FROM (SELECT id FROM logs "
+                                                    "WHERE id > ? ORDER BY id LIMIT ?)",
+                                                    (start, self.batch_size))
+                if not count:
+                    return total
+                async with self.db.transaction() as connection:
+                    await connection.execute(
+                        "INSERT INTO activity_daily (user_id, day, messages, commands, first_at, last_at) "
+                        "SELECT user_id, substr(datetime, 1, 10), SUM(action = 'send_message'), "
+                        "SUM(action = 'use_command'), MIN(datetime), MAX(datetime) FROM logs "
+                        "WHERE id > ? AND id <= ? GROUP BY user_id, substr(datetime, 1, 10) "
+                        "ON CONFLICT (user_id, day) DO UPDATE SET messages = messages + excluded.messages, "
+                        "commands = commands + excluded.commands, first_at = MIN(first_at, excluded.first_at), "
+                        "last_at = MAX(last_at, excluded.last_at)", (start, end))
+                    await connection.execute("INSERT INTO maintenance (key, value) VALUES ('logs_rollup', ?) "
+                                             "ON CONFLICT (key) DO UPDATE SET value = excluded.value", (end,))
+                total += count
+                self.stats["rolled_up"] += count
+
+    async def archive(self) -> int:
+        cutoff = (datetime.datetime.now(datetime.timezone.utc)
+                  - datetime.timedelta(days=self.retention_days)).strftime("%Y-%m-%d")
+        path = os.path.join(self.archive_dir, f"logs-{datetime.date.today().isoformat()}.jsonl.gz")
+        total = 0
+        async with self.lock:
+            watermark = await self.watermark()
+            while True:
+                rows = await self.db.fetchall("SELECT id, user_id, action, text, datetime FROM logs "
+                                              "WHERE id <= ? AND datetime < ? ORDER BY id LIMIT ?",
+                                              (watermark, cutoff, self.batch_size))
+                if not rows:
+                    break
+                await asyncio.to_thread(self._write, path, rows)
+                await self.db.execute("DELETE FROM logs WHERE id <= ? AND datetime < ?", (rows[-1][0], cutoff))
+                total += len(rows)
+                self.stats["archived"] += len(rows)
+        if total:
+            logger.info("Archived %d log rows older than %s to %s", total, cutoff, path)
+        return total
+
+    def _write(self, path: str, rows):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        # Каждая выгрузка дописывается в файл дня отдельным gzip-блоком
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            for _, user_id, action, text, date in rows:
+                f.write(json.dumps({"user_id": user_id, "action": action, "text": text, "datetime": date},
+                                   ensure_ascii=False) + "\n")
+
+    async def vacuum(self):
+        # Полный VACUUM здесь не запускается: базу в режим incremental переводит enable_incremental_vacuum при старте
+        async with self.db.connection() as connection:
+            async with connection.execute("PRAGMA freelist_count") as cursor:
+                free = (await cursor.fetchone())[0]
+            if free:
+                # execute делает один шаг запроса, а incremental_vacuum освобождает по странице за шаг
+                await connection.executescript(f"PRAGMA incremental_vacuum({self.vacuum_pages});")
+                self.stats["vacuumed_pages"] += min(free, self.vacuum_pages)
+
+    async def run(self):
+        for step in (self.rollup, self.archive, self.vacuum):
+            try:
+                await step()
+            except Exception:
+                logger.exception("Log maintenance step %s failed", step.__name__)
+                self.stats["errors"] += 1
+
+
+class UserActivity:
+    __slots__ = ("days", "active_days", "messages", "commands", "streak", "last_day")
+
+    def __init__(self, days, active_days, messages, commands, streak, last_day):
+        self.days = days
+        self.active_days = active_days
+        self.messages = messages
+        self.commands = commands
+        self.streak = streak
+        self.last_day = last_day
+
+
+class ActivityRepository:
+    # Статистика пользователя по свёрткам activity_daily; записи, которые ещё не свёрнуты,
+    # досчитываются из logs по индексу (user_id, datetime) только за запрошенный период
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def user_stats(self, user_id: int, days=30) -> UserActivity:
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        since = (today - datetime.timedelta(days=days - 1)).isoformat()
+        totals: Dict[str, List[int]] = {}
+        # Свёртки, водяной знак и несвёрнутые записи читаются одним запросом: иначе свёртка, завершившаяся
+        # между чтениями, посчитала бы одни и те же записи дважды
+        rows = await self.db.fetchall("SELECT day, SUM(messages), SUM(commands) FROM ("
+                                      "SELECT day, messages, commands FROM activity_daily "
+                                      "WHERE user_id = ? AND day >= ? UNION ALL "
+                                      "SELECT substr(datetime, 1, 10), action = 'send_message', "
+                                      "action = 'use_command' FROM logs WHERE user_id = ? AND datetime >= ? "
+                                      "AND id > IFNULL((SELECT value FROM maintenance WHERE key = 'logs_rollup'), 0)"
+                                      ") GROUP BY day", (user_id, since, user_id, since))
+        for day, messages, commands in rows:
+            total = totals.setdefault(day, [0, 0])
+            total[0] += messages
+            total[1] += commands
+        streak = 0
+        day = today if today.isoformat() in totals else today - datetime.timedelta(days=1)
+        while day.isoformat() in totals:
+            streak += 1
+            day -= datetime.timedelta(days=1)
+        return UserActivity(days, len(totals), sum(total[0] for total in totals.values()),
+                            sum(total[1] for total in totals.values()), streak, max(totals, default=None))
+
+
+db = Database(config.get("Database", "path", fallback="bot.db"),
+              pool_size=config.getint("Database", "pool_size", fallback=4))
+users = UserRepository(db, UserCache(max_size=config.getint("Cache", "users_max_size", fallback=10000),
+                                      ttl=config.getfloat("Cache", "users_ttl", fallback=600)))
+words = WordRepository(db)
+matcher = AnswerMatcher()
+prefetcher = WordPrefetcher(gateway, words,
+                            batch_size=config.getint("Words", "batch_size", fallback=20),
+                            low_watermark=config.getint("Words", "low_watermark", fallback=5))
+topics = TopicLibrary(gateway, TopicRepository(db),
+                      min_size=config.getint("Topics", "min_size", fallback=10),
+                      max_size=config.getint("Topics", "max_size", fallback=50))
+memory = ConversationMemory(db, gateway,
+                            max_turns=config.getint("Memory", "max_turns", fallback=8),
+                            token_budget=config.getint("Memory", "token_budget", fallback=1500),
+                            summary_tokens=config.getint("Memory", "summary_tokens", fallback=300),
+                            ttl=config.getfloat("Memory", "ttl", fallback=30 * 24 * 3600))
+responses = ResponseCache(db, gateway,
+                          max_size=config.getint("Cache", "llm_max_size", fallback=1000),
+                          max_rows=config.getint("Cache", "llm_max_rows", fallback=50000),
+                          ttl=config.getfloat("Cache", "llm_ttl", fallback=7 * 24 * 3600))
+logs = LogRepository(db)
+log_maintenance = LogMaintenance(db,
+                                 archive_dir=config.get("Logs", "archive_dir", fallback="logs_archive"),
+                                 retention_days=config.getint("Logs", "retention_days", fallback=90))
+activity = ActivityRepository(db)
+reminders = ReminderScheduler(users)
+log_writer = LogWriter(logs,
+                       batch_size=config.getint("Logs", "batch_size", fallback=200),
+                       flush_interval=config.getfloat("Logs", "flush_interval", fallback=1.0),
+                       max_pending=config.getint("Logs", "max_pending", fallback=20000))
+
+
+class SQLiteStorage(BaseStorage):
+    # Состояния FSM хранятся в bot.db и переживают перезапуск. Горячие состояния кэшируются в памяти,
+    # запись идёт сразу в базу. При нескольких процессах кэш стоит отключить: cache_ttl = 0.
+    def __init__(self, db: Database, state_ttl=7 * 24 * 3600, cache_ttl=300.0, cache_size=10000):
+        self.db = db
+        self.state_ttl = state_ttl
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self.cache: OrderedDict = OrderedDict()
+
+    async def _load(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        entry = self.cache.get(key)
+        if entry is not None and entry[2] > time.monotonic():
+            self.cache.move_to_end(key)
+            return entry[0], entry[1]
+        row = await self.db.fetchone("SELECT state, data FROM fsm_states WHERE key = ? AND updated > ?",
+                                     (key, time.time() - self.state_ttl))
+        state, data = (row[0], json.loads(row[1])) if row is not None else (None, {})
+        self._remember(key, state, data)
+        return state, data
+
+    def _remember(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        if self.cache_ttl <= 0:
+            return
+        self.cache[key] = (state, data, time.monotonic() + self.cache_ttl)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _update(self, key: str, **fields):
+        entry = self.cache.get(key)
+        if entry is None or entry[2] <= time.monotonic():
+            self.cache.pop(key, None)
+            return
+        self._remember(key, fields.get("state", entry[0]), fields.get("data", entry[1]))
+
+    # set_state и set_data пишут каждый только свой столбец, чтобы одновременные изменения из разных
+    # процессов не затирали друг друга. Второй столбец устаревшей записи при этом сбрасывается.
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self.key_builder.build(key)
+        state = state.state if isinstance(state, State) else state
+        now = time.time()
+        await self.db.execute("INSERT INTO fsm_states (key, state, data, updated) VALUES (?, ?, '{}', ?) "
+                              "ON CONFLICT (key) DO UPDATE SET state = excluded.state, "
+                              "data = CASE WHEN updated > ? THEN data ELSE '{}' END, updated = excluded.updated",
+                              (storage_key, state, now, now - self.state_ttl))
+        self._update(storage_key, state=state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        storage_key = self.key_builder.build(key)
+        data = dict(data)
+        now = time.time()
+        await self.db.execute("INSERT INTO fsm_states (key, state, data, updated) VALUES (?, NULL, ?, ?) "
+                              "ON CONFLICT (key) DO UPDATE SET data = excluded.data, "
+                              "state = CASE WHEN updated > ? THEN state ELSE NULL END, updated = excluded.updated",
+                              (storage_key, json.dumps(data, ensure_ascii=False), now, now - self.state_ttl))
+        self._update(storage_key, data=data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self.key_builder.build(key))
+        return dict(data)
+
+    async def purge(self):
+        await self.db.execute("DELETE FROM fsm_states WHERE updated <= ? OR (state IS NULL AND data = '{}')",
+                              (time.time() - self.state_ttl,))
+
+    async def close(self) -> None:
+        self.cache.clear()
+
+
+storage = SQLiteStorage(db,
+                        state_ttl=config.getfloat("FSM", "state_ttl", fallback=7 * 24 * 3600),
+                        cache_ttl=config.getfloat("FSM", "cache_ttl", fallback=300))
+dp = Dispatcher(storage=storage)
+
+
+class TimingMiddleware(BaseMiddleware):
+    # Внешний на dp.update – полное время обновления вместе с остальными middleware,
+    # внутренний на наблюдателях событий – время самого хендлера.
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get("handler")
+        if handler_object is not None:
+            with metrics.timer("bot_handler_seconds", handler=handler_object.callback.__name__):
+                return await handler(event, data)
+
+        update_type = event.event_type
+        metrics.inc("bot_updates_total", type=update_type)
+        spans = [] if TRACE_THRESHOLD > 0 else None
+        token = metrics.trace.set(spans)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc("bot_update_errors_total", type=update_type)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.trace.reset(token)
+            metrics.observe("bot_update_seconds", elapsed, type=update_type)
+            if spans is not None and elapsed >= TRACE_THRESHOLD:
+                logger.info("Slow update %s (%s) %.3fs: %s", event.update_id, update_type, elapsed,
+                            "; ".join(f"{name}{Metrics.labels(tuple(labels.items()))} {seconds:.3f}s"
+                                      for name, labels, seconds in spans))
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    # Ограничение частоты обновлений от одного пользователя: токен-бакет на пользователя (rate в секунду,
+    # подряд до burst), повторное нажатие той же кнопки в пределах debounce секунд отбрасывается.
+    # О превышении лимита пользователь узнаёт один раз, пока бакет снова не пропустит обновление.
+    def __init__(self, rate=1.0, burst=5, debounce=1.0, max_users=10000):
+        self.rate = rate
+        self.burst = burst
+        self.debounce = debounce
+        self.max_users = max_users
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.taps: Dict[Tuple[int, str], float] = {}
+        self.warned = set()
+        self.stats = {"passed": 0, "throttled": 0, "debounced": 0}
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        callback = event if isinstance(event, CallbackQuery) else None
+
+        if callback is not None and self.debounce > 0:
+            now = time.monotonic()
+            key = (user.id, callback.data)
+            if now - self.taps.get(key, -self.debounce) < self.debounce:
+                self.stats["debounced"] += 1
+                await callback.answer()
+                return
+            if len(self.taps) > self.max_users:
+                self.taps = {k: tapped for k, tapped in self.taps.items() if now - tapped < self.debounce}
+            self.taps[key] = now
+
+        bucket = self.buckets.get(user.id)
+        if bucket is None:
+            if len(self.buckets) > self.max_users:
+                self.buckets = {k: value for k, value in self.buckets.items() if not value.full}
+                self.warned &= self.buckets.keys()
+            bucket = self.buckets[user.id] = TokenBucket(self.rate, self.burst)
+        if bucket.delay() > 0:
+            self.stats["throttled"] += 1
+            warn = user.id not in self.warned
+            self.warned.add(user.id)
+            if callback is not None:
+                await callback.answer("Слишком часто, подождите немного" if warn else None)
+            elif warn:
+                await outbox.send(event.chat.id, "Слишком много сообщений, подождите немного")
+            return
+        bucket.consume()
+        self.warned.discard(user.id)
+        self.stats["passed"] += 1
+        return await handler(event, data)
+
+
+throttling = ThrottlingMiddleware(rate=config.getfloat("Throttling", "rate", fallback=1.0),
+                                  burst=config.getint("Throttling", "burst", fallback=5),
+                                  debounce=config.getfloat("Throttling", "debounce", fallback=1.0))
+
+
 class SomeMiddleware(BaseMiddleware):
     async def __call__(
             self,
@@ -88,63 +1934,50 @@ class SomeMiddleware(BaseMiddleware):
             event: TelegramObject,
             data: Dict[str, Any]
     ) -> Any:
+        started = time.perf_counter()
         message: Message = data['event_update'].message
         chat_id = message.chat.id
         state: FSMContext = data.get('state')
         current_state = await state.get_state()
 
-        async with aiosqlite.connect('bot.db') as db:
-            if message.text[0] == '/':
-                action = "use_command"
-            else:
-                action = "send_message"
-            await db.execute("INSERT INTO logs (user_id, action, text, datetime) VALUES (?, ?, ?, ?)",
-                             (message.from_user.id, action, message.text, message.date))
-            await db.commit()
-
-        async with aiosqlite.connect('bot.db') as db:
-            cursor = await db.execute("SELECT * FROM users")
-            rows = await cursor.fetchall()
+        if message.text[0] == '/':
+            action = "use_command"
+        else:
+            action = "send_message"
+        log_writer.write(message.from_user.id, action, message.text, message.date)
 
         if message.text != '/start' and current_state != Form.name:
-            async with aiosqlite.connect('bot.db') as db:
-                async with db.execute("SELECT id FROM users WHERE id = ?", (chat_id,)) as cursor:
-                    if await cursor.fetchone() is None:
-                        await bot.send_message(chat_id=chat_id,
-                                               text='Вы не зарегистрированы! Зарегистрируйтесь, используя команду '
-                                                    '/start')
-                        return
+            if not await users.exists(chat_id):
+                await outbox.send(chat_id=chat_id,
+                                  text='Вы не зарегистрированы! Зарегистрируйтесь, используя команду '
+                                       '/start')
+                return
+        metrics.observe("bot_middleware_seconds", time.perf_counter() - started, middleware="SomeMiddleware")
         result = await handler(event, data)
         return result
 
 
 @dp.message(CommandStart(), State(None))
 async def cmd_start(message: Message, state: FSMContext):
-    async with aiosqlite.connect('bot.db') as db:
-        async with db.execute("SELECT id FROM users WHERE id = ?", (message.from_user.id,)) as cursor:
-            if await cursor.fetchone() is None:
-                await message.answer(f"Привет, {message.from_user.first_name}!\nДля начала работы введите Ваши "
-                                     f"фамилию и имя:")
-                await state.update_data(lastfirstname=f"{message.from_user.last_name} {message.from_user.first_name}")
-                await state.set_state(Form.name)
-                return
-        await bot.send_message(chat_id=message.from_user.id,
-                               text="Меню",
-                               reply_markup=Keyboard.menu_keyboard)
+    if not await users.exists(message.from_user.id):
+        await outbox.send(message.chat.id, f"Привет, {message.from_user.first_name}!\nДля начала работы введите Ваши "
+                                           f"фамилию и имя:")
+        await state.update_data(lastfirstname=f"{message.from_user.last_name} {message.from_user.first_name}")
+        await state.set_state(Form.name)
+        return
+    await outbox.send(chat_id=message.from_user.id,
+                      text="Меню",
+                      reply_markup=Keyboard.menu_keyboard)
 
 
 @dp.message(Form.name)
 async def name_enter(message: Message, state: FSMContext):
     if len(message.text.split()) != 2:
-        await message.answer(
-            f"Проверь правильность написания, для регистрации нужно ввести фамилию и имя.")
+        await outbox.send(message.chat.id,
+                          f"Проверь правильность написания, для регистрации нужно ввести фамилию и имя.")
         return
     last_name, first_name = message.text.split()
-    async with aiosqlite.connect('bot.db') as db:
-        async with db.execute("SELECT id FROM users WHERE id = ?", (message.from_user.id,)) as cursor:
-            await cursor.execute('INSERT INTO users (id, last_name, first_name) VALUES (?, ?, ?)',
-                                 (message.from_user.id, last_name, first_name))
-            await db.commit()
+    await users.create(message.from_user.id, last_name, first_name)
     await state.clear()
 
     button_1 = KeyboardButton(text=LANGUAGES['en'])
@@ -157,21 +1990,19 @@ async def name_enter(message: Message, state: FSMContext):
                                    resize_keyboard=True)
 
     await state.set_state(Form.choose_language)
-    await message.answer(text=f"Данные зарегистрированы!\n\n"
-                              f"Теперь необходимо выбрать язык для изучения на клавиатуре.",
-                         reply_markup=keyboard)
+    await outbox.send(message.chat.id, text=f"Данные зарегистрированы!\n\n"
+                                            f"Теперь необходимо выбрать язык для изучения на клавиатуре.",
+                                       reply_markup=keyboard)
 
 
 @dp.message(Command("help"))
 async def cmd_help(message: Message):
-    async with aiosqlite.connect('bot.db') as db:
-        cursor = await db.execute("SELECT * FROM logs")
-        rows = await cursor.fetchall()
-    await message.answer("Вот список доступных команд:\n"
-                         "/help – Показать описание команд\n"
-                         "/choose – Выбор или смена изучаемого языка\n"
-                         "/set_time – Поставить напоминание с новым словом для изучения (доступно только после выбора "
-                         "языка)")
+    await outbox.send(message.chat.id, "Вот список доступных команд:\n"
+                                       "/help – Показать описание команд\n"
+                                       "/choose – Выбор или смена изучаемого языка\n"
+                                       "/stats – Статистика занятий за последний месяц\n"
+                                       "/set_time – Поставить напоминание с новым словом для изучения (доступно "
+                                       "только после выбора языка)")
 
 
 @dp.message(Command("choose"))
@@ -184,19 +2015,17 @@ async def cmd_choose(message: Message, state: FSMContext):
     button_6 = KeyboardButton(text="❌ Отмена")
     keyboard = ReplyKeyboardMarkup(keyboard=[[button_1, button_2, button_3], [button_4, button_5], [button_6]],
                                    resize_keyboard=True)
-    async with aiosqlite.connect('bot.db') as db:
-        cursor = await db.execute("SELECT current_language FROM users WHERE id = (?)", (message.from_user.id,))
-        language = await cursor.fetchone()
-        language = language[0]
-
-    if language == "":
-        await message.answer(text="Выберете язык из доступных на клавиатуре.",
-                             reply_markup=keyboard)
+    profile = await users.get(message.from_user.id)
+
+    if not profile.current_language:
+        await outbox.send(message.chat.id, text="Выберете язык из доступных на клавиатуре.",
+                                           reply_markup=keyboard)
     else:
-        await message.answer(text="❗️У вас уже выбран язык. При выборе другого прогресс будет потерян. \n\nЕсли вы "
-                                  "хотите выйти из выбора языка для изучения, выберите кнопку  ❌ Отмена. Иначе "
-                                  "выберете язык из доступных на клавиатуре.",
-                             reply_markup=keyboard)
+        await outbox.send(message.chat.id, text="❗️У вас уже выбран язык. При выборе другого прогресс будет "
+                                                "потерян. \n\nЕсли вы хотите выйти из выбора языка для изучения, "
+                                                "выберите кнопку  ❌ Отмена. Иначе выберете язык из доступных на "
+                                                "клавиатуре.",
+                                           reply_markup=keyboard)
     await state.set_state(Form.choose_language)
 
 
@@ -204,21 +2033,18 @@ async def cmd_choose(message: Message, state: FSMContext):
 async def choose_language(message: Message, state: FSMContext):
     if message.text not in LANGUAGES.values():
         if message.text == "❌ Отмена":
-            await message.answer(text="Хорошо! Отменяю выбор языка.",
-                                 reply_markup=ReplyKeyboardRemove())
+            await outbox.send(message.chat.id, text="Хорошо! Отменяю выбор языка.",
+                                               reply_markup=ReplyKeyboardRemove())
             await state.clear()
             return
 
-        await message.answer(text="Такой язык пока что недоступен, вы можете выбрать другой на клавиатуре")
+        await outbox.send(message.chat.id, text="Такой язык пока что недоступен, вы можете выбрать другой на "
+                                                "клавиатуре")
         return
     for code, language in LANGUAGES.items():
         if language == message.text:
-            async with aiosqlite.connect('bot.db') as db:
-                await db.execute('UPDATE users SET (current_language) = (?) WHERE id = (?)',
-                                 (code, message.from_user.id))
-                await db.execute('DELETE FROM words WHERE user_id = (?)',
-                                 (message.from_user.id,))
-                await db.commit()
+            await users.set_language(message.from_user.id, code)
+            await memory.clear(message.from_user.id)
 
             button_1 = KeyboardButton(text="Новичок A0")
             button_2 = KeyboardButton(text="Начальный A1-A2")
@@ -226,172 +2052,160 @@ async def choose_language(message: Message, state: FSMContext):
             button_4 = KeyboardButton(text="Профессиональный C1")
             keyboard = ReplyKeyboardMarkup(keyboard=[[button_1, button_2], [button_3, button_4]],
                                            resize_keyboard=True)
-            await message.answer(text=f"Вы выбрали {message.text} язык.\n\nТеперь необходимо выбрать "
-                                      f"уровень языка на клавиатуре.",
-                                 reply_markup=keyboard)
+            await outbox.send(message.chat.id, text=f"Вы выбрали {message.text} язык.\n\nТеперь необходимо выбрать "
+                                                    f"уровень языка на клавиатуре.",
+                                               reply_markup=keyboard)
             await state.set_state(Form.choose_level)
 
 
 @dp.message(Form.choose_level)
-async def choose_language(message: Message, state: FSMContext):
+async def choose_level(message: Message, state: FSMContext):
     for code, level in LEVELS.items():
         if level == message.text:
-            async with aiosqlite.connect('bot.db') as db:
-                await db.execute('UPDATE users SET (current_level) = (?) WHERE id = (?)',
-                                 (code, message.from_user.id))
-                await db.commit()
-                await message.answer(
-                    text="Хорошо, записал ваш уровень. Буду рекомендовать темы и слова именно по вашему "
-                         "уровню!",
-                    reply_markup=ReplyKeyboardRemove())
-                await state.clear()
-                return
-    await message.answer(text="Выбирете что-то на клавиатуре.")
+            await users.set_level(message.from_user.id, code)
+            profile = await users.get(message.from_user.id)
+            if profile is not None and profile.current_language:
+                prefetcher.ensure(profile.current_language, code)
+                topics.refresh(profile.current_language, code)
+            await outbox.send(message.chat.id,
+                              text="Хорошо, записал ваш уровень. Буду рекомендовать темы и слова именно по вашему "
+                                   "уровню!",
+                              reply_markup=ReplyKeyboardRemove())
+            await state.clear()
+            return
+    await outbox.send(message.chat.id, text="Выбирете что-то на клавиатуре.")
 
 
 @dp.message(Command("menu"))
 async def cmd_menu(message: Message):
-    await message.answer(text="Меню",
-                         reply_markup=Keyboard.menu_keyboard)
+    await outbox.send(message.chat.id, text="Меню",
+                                       reply_markup=Keyboard.menu_keyboard)
 
 
 @dp.callback_query(F.data == "study_words")
 async def callback_study_words(callback: CallbackQuery, state: FSMContext):
-    async with aiosqlite.connect('bot.db') as db:
-        async with db.execute("SELECT * FROM words WHERE user_id = (?) and repeat > 0",
-                              (callback.from_user.id,)) as cursor:
-            results = await cursor.fetchall()
-            if len(results) > 0 and randint(1, 10) % 2 == 0:
-                foreign_word = results[randint(0, len(results) - 1)][1]
-                await state.update_data(word=foreign_word)
-                await state.set_state(Form.study_translate)
-                exit_button = InlineKeyboardButton(text="Отмена",
-                                                   callback_data="exit")
-                await bot.send_message(chat_id=callback.from_user.id,
-                                       text=f"Давайте повторим слово {foreign_word}\n"
-                                            f"Вам необходимо написать его перевод",
-                                       reply_markup=InlineKeyboardMarkup(inline_keyboard=[[exit_button]]))
-                await callback.answer()
-                return
+    due = await words.next_due(callback.from_user.id)
+    if due is not None:
+        foreign_word, translation = due
+        await state.update_data(word=foreign_word, translation=translation, attempts=0)
+        await state.set_state(Form.study_translate)
+        exit_button = InlineKeyboardButton(text="Отмена",
+                                           callback_data="exit")
+        await outbox.send(chat_id=callback.from_user.id,
+                          text=f"Давайте повторим слово {foreign_word}\n"
+                               f"Вам необходимо написать его перевод",
+                          reply_markup=InlineKeyboardMarkup(inline_keyboard=[[exit_button]]))
+        await callback.answer()
+        return
 
-        async with db.execute("SELECT * FROM users WHERE id = (?)", (callback.from_user.id,)) as cursor:
-            async for row in cursor:
-                user_lang, user_lvl = LANGUAGES[row[3]], LEVELS[row[4]]
-
-                norm = True
-                while norm:
-                    try:
-                        messages = [SystemMessage(
-                            content=f"Ты бот-репетитор по {user_lang}, с тобой занимается пользователь уровня "
-                                    f"{user_lvl}, ты помогаешь пользователю изучать язык."
-                        ), HumanMessage(content='Предложи новое слово. Формат ответа: "(слово, перевод этого слова)". '
-                                                'Не пиши ничего лишнего.')]
-                        res = llm.invoke(messages)
-                        foreign_word, russian_word = res.content.replace('(', '').replace(')', '').split(', ')
-                        messages.append(res)
-                        norm = False
-                    except:
-                        print("Ошибка: глупая нейронка")
-
-                await bot.send_message(chat_id=callback.from_user.id,
-                                       text=f'Новое слово для изучения – {foreign_word}\n'
-                                            f'Оно означает "{russian_word}"')
-                await db.execute("INSERT INTO words (user_id, word, translation, repeat) VALUES (?, ?, ?, ?)",
-                                 (callback.from_user.id, foreign_word, russian_word, 2))
-                await db.commit()
-                await callback.answer()
+    profile = await users.get(callback.from_user.id)
+    if profile is None:
+        return
+    pair = await prefetcher.pop(callback.from_user.id, profile.current_language, profile.current_level)
+    if pair is None:
+        await callback.answer("Не получилось подобрать новое слово, попробуйте ещё раз чуть позже", show_alert=True)
+        return
+    foreign_word, russian_word = pair
+
+    await outbox.send(chat_id=callback.from_user.id,
+                      text=f'Новое слово для изучения – {foreign_word}\n'
+                           f'Оно означает "{russian_word}"')
+    await words.add(callback.from_user.id, foreign_word, russian_word)
+    await callback.answer()
 
 
 @dp.message(Form.study_translate)
 async def study_translate(message: Message, state: FSMContext):
-    foreign_word = await state.get_data()
-    foreign_word = foreign_word['word']
-    messages = [HumanMessage(content=f"Тебе нужно проверить: совпадает ли {foreign_word} с переводом {message.text}. "
-                                     f"Напиши только Да или Нет.")]
-    res = llm.invoke(messages)
-    if res.content.lower() == "да":
-        await message.answer("Правильно!")
-        async with aiosqlite.connect('bot.db') as db:
-            async with db.execute("SELECT * FROM words WHERE user_id = (?) and word = (?)",
-                                  (message.from_user.id, foreign_word)) as cursor:
-                async for row in cursor:
-                    repeat = row[3]
-                    await db.execute("UPDATE words SET repeat = (?) WHERE user_id = (?) and word = (?)",
-                                     (repeat - 1, message.from_user.id, foreign_word))
-                    await db.commit()
-                    await state.clear()
+    data = await state.get_data()
+    foreign_word = data['word']
+    translation = data.get('translation') or await words.get_translation(message.from_user.id, foreign_word) or ""
+    verdict = matcher.match(message.text or "", foreign_word, translation)
+    if verdict == AnswerMatcher.UNSURE:
+        messages = [HumanMessage(content=f"Тебе нужно проверить: совпадает ли {foreign_word} с переводом "
+                                         f"{message.text}. Напиши только Да или Нет.")]
+        try:
+            res = await responses.invoke(message.from_user.id, messages)
+        except Exception as e:
+            if not isinstance(e, LLMUnavailable):
+                logger.exception("LLM request failed")
+            await outbox.send(message.chat.id, llm_error_text(e, "Не удалось проверить ответ, попробуйте ещё раз "
+                                                                 "чуть позже"))
+            return
+        verdict = AnswerMatcher.CORRECT if res.content.lower().strip(" .!") == "да" else AnswerMatcher.WRONG
+    if verdict == AnswerMatcher.CORRECT:
+        await outbox.send(message.chat.id, "Правильно!")
+        await words.review(message.from_user.id, foreign_word, SpacedRepetition.quality(data.get('attempts', 0)))
+        await state.clear()
     else:
-        await message.answer("Неправильно, повтори попытку")
+        await state.update_data(attempts=data.get('attempts', 0) + 1)
+        await outbox.send(message.chat.id, "Неправильно, повтори попытку")
 
 
 @dp.callback_query(F.data == "exit")
 async def exit_callback(callback: CallbackQuery, state: FSMContext):
     await state.clear()
-    await bot.send_message(chat_id=callback.from_user.id,
-                           text="Меню",
-                           reply_markup=Keyboard.menu_keyboard)
+    await outbox.send(chat_id=callback.from_user.id,
+                      text="Меню",
+                      reply_markup=Keyboard.menu_keyboard)
     await callback.answer()
 
 
 @dp.callback_query(F.data == "study_topics")
 async def study_topics(callback: CallbackQuery):
-    async with aiosqlite.connect('bot.db') as db:
-        async with db.execute("SELECT * FROM users WHERE id = (?)", (callback.from_user.id,)) as cursor:
-            async for row in cursor:
-                user_lang, user_lvl = LANGUAGES[row[3]], LEVELS[row[4]]
-                messages = [SystemMessage(content=f"Ты бот-репетитор по {user_lang}, с тобой занимается пользователь "
-                                                  f"уровня {user_lvl}, ты помогаешь пользователю изучать язык."),
-                            HumanMessage(content=f"Нужно доступно объяснить любую тему по грамматике")]
-                res = llm.invoke(messages)
-                await bot.send_message(chat_id=callback.from_user.id,
-                                       text=res.content)
-                await callback.answer()
+    profile = await users.get(callback.from_user.id)
+    if profile is None:
+        return
+    try:
+        content = await topics.get(callback.from_user.id, profile.current_language, profile.current_level)
+    except Exception as e:
+        if not isinstance(e, LLMUnavailable):
+            logger.exception("Topic lookup failed")
+        await callback.answer(llm_error_text(e), show_alert=True)
+        return
+    await outbox.send(chat_id=callback.from_user.id,
+                      text=content)
+    await callback.answer()
 
 
 @dp.message(Command("on"))
 async def cmd_on(message: Message, state: FSMContext):
-    async with aiosqlite.connect('bot.db') as db:
-        user_language = await db.execute('SELECT current_language FROM users WHERE id = (?) AND current_language <> ""',
-                                         (message.from_user.id,))
-        user_language = await user_language.fetchone()
-        if user_language is None:
-            await message.answer(text="Вы сможете настроить уведомления после выбора изучаемого языка\n\n"
-                                      "Подсказка: /choose")
-            return
-        await message.answer("Для установления времени напоминания введите час, в который я буду тебе писать.\n\n"
-                             "Например: 13\n"
-                             "Тогда я буду отправлять напоминание в 13.00 по МСК\n"
-                             "Для отмены напиши слово Отмена")
-        await state.set_state(Form.reminder_time_enter)
+    profile = await users.get(message.from_user.id)
+    if profile is None or not profile.current_language:
+        await outbox.send(message.chat.id, text="Вы сможете настроить уведомления после выбора изучаемого языка\n\n"
+                                                "Подсказка: /choose")
+        return
+    await outbox.send(message.chat.id, "Для установления времени напоминания введите час, в который я буду "
+                                       "тебе писать.\n\n"
+                                       "Например: 13\n"
+                                       "Тогда я буду отправлять напоминание в 13.00 по МСК\n"
+                                       "Для отмены напиши слово Отмена")
+    await state.set_state(Form.reminder_time_enter)
 
 
 @dp.callback_query(F.data == "set_reminder")
 async def callback_set_reminder(callback: CallbackQuery, state: FSMContext):
-    async with aiosqlite.connect('bot.db') as db:
-        user_language = await db.execute('SELECT current_language FROM users WHERE id = (?) AND current_language <> ""',
-                                         (callback.from_user.id,))
-        user_language = await user_language.fetchone()
-        if user_language is None:
-            await bot.send_message(chat_id=callback.from_user.id,
-                                   text="Вы сможете настроить уведомления после выбора изучаемого языка\n\n"
-                                        "Подсказка: /choose")
-            await callback.answer()
-            return
-        await bot.send_message(chat_id=callback.from_user.id,
-                               text="Для установления времени напоминания введите час, в который я буду тебе "
-                                    "писать.\n\n"
-                                    "Например: 13\n"
-                                    "Тогда я буду отправлять напоминание в 13.00 по МСК\n"
-                                    "Для отмены напиши слово Отмена")
+    profile = await users.get(callback.from_user.id)
+    if profile is None or not profile.current_language:
+        await outbox.send(chat_id=callback.from_user.id,
+                          text="Вы сможете настроить уведомления после выбора изучаемого языка\n\n"
+                               "Подсказка: /choose")
         await callback.answer()
-        await state.set_state(Form.reminder_time_enter)
+        return
+    await outbox.send(chat_id=callback.from_user.id,
+                      text="Для установления времени напоминания введите час, в который я буду тебе "
+                           "писать.\n\n"
+                           "Например: 13\n"
+                           "Тогда я буду отправлять напоминание в 13.00 по МСК\n"
+                           "Для отмены напиши слово Отмена")
+    await callback.answer()
+    await state.set_state(Form.reminder_time_enter)
 
 
 @dp.message(Form.reminder_time_enter)
 async def time_enter(message: Message, state: FSMContext):
     if message.text == "Отмена":
         await state.clear()
-        await message.answer("Хорошо, вернул в меню.")
+        await outbox.send(message.chat.id, "Хорошо, вернул в меню.")
         return
 
     try:
@@ -400,46 +2214,116 @@ async def time_enter(message: Message, state: FSMContext):
         number = 100
 
     if number < 0 or number > 23:
-        await message.answer("Введено неправильное значение, попробуйте снова.")
+        await outbox.send(message.chat.id, "Введено неправильное значение, попробуйте снова.")
         return
 
-    async with aiosqlite.connect('bot.db') as db:
-        await db.execute('UPDATE users SET (reminder) = (?) WHERE id = (?)',
-                         (number, message.from_user.id))
-        await db.commit()
+    await reminders.set(message.from_user.id, number)
 
-    await message.answer(f"⏰ Хорошо! Буду уведомлять вас в {number} часов каждый день.\n\n"
-                         f"Для выключения напоминаний используйте команду /off")
-    await bot.send_message(chat_id=message.from_user.id,
-                           text="Меню",
-                           reply_markup=Keyboard.menu_keyboard)
+    await outbox.send(message.chat.id, f"⏰ Хорошо! Буду уведомлять вас в {number} часов каждый день.\n\n"
+                                       f"Для выключения напоминаний используйте команду /off")
+    await outbox.send(chat_id=message.from_user.id,
+                      text="Меню",
+                      reply_markup=Keyboard.menu_keyboard)
     await state.clear()
 
 
 @dp.message(Command("off"))
 async def cmd_off(message: Message):
-    async with aiosqlite.connect('bot.db') as db:
-        await db.execute('UPDATE users SET reminder = null WHERE id = (?)',
-                         (message.from_user.id,))
-        await db.commit()
-    await message.answer("Вы отключили напоминания.")
+    await reminders.set(message.from_user.id, None)
+    await outbox.send(message.chat.id, "Вы отключили напоминания.")
+
+
+@dp.message(Command("stats"))
+async def cmd_stats(message: Message):
+    stats = await activity.user_stats(message.from_user.id)
+    await outbox.send(message.chat.id, f"📊 Ваша активность за {stats.days} дней\n\n"
+                                       f"Дней с занятиями: {stats.active_days}\n"
+                                       f"Дней подряд: {stats.streak}\n"
+                                       f"Сообщений: {stats.messages}\n"
+                                       f"Команд: {stats.commands}\n"
+                                       f"Слов в словаре: {await words.count(message.from_user.id)}")
 
 
 @dp.message(State(None))
 async def prtext(message: Message):
-    async with aiosqlite.connect('bot.db') as db:
-        async with db.execute("SELECT * FROM users WHERE id = (?)", (message.from_user.id,)) as cursor:
-            async for row in cursor:
-                user_lang, user_lvl = LANGUAGES[row[3]], LEVELS[row[4]]
-                messages = [SystemMessage(content=f"Ты бот-репетитор по {user_lang}, с тобой занимается пользователь "
-                                                  f"уровня {user_lvl}, ты помогаешь пользователю изучать язык. "
-                                                  f"Если вопрос не связан с изучением языка, скажи, что ты не можешь "
-                                                  f"ничего сказать по этой теме – это важно. Тебе нельзя разговаривать "
-                                                  f"на другие темы."),
-                            HumanMessage(content=message.text)]
-                res = llm.invoke(messages)
-                await bot.send_message(chat_id=message.from_user.id,
-                                       text=res.content)
+    profile = await users.get(message.from_user.id)
+    if profile is None:
+        return
+    user_lang, user_lvl = LANGUAGES[profile.current_language], LEVELS[profile.current_level]
+    conversation = await memory.get(message.from_user.id)
+    messages = memory.build(conversation,
+                            f"Ты бот-репетитор по {user_lang}, с тобой занимается пользователь "
+                            f"уровня {user_lvl}, ты помогаешь пользователю изучать язык. "
+                            f"Если вопрос не связан с изучением языка, скажи, что ты не можешь "
+                            f"ничего сказать по этой теме – это важно. Тебе нельзя разговаривать "
+                            f"на другие темы.",
+                            message.text)
+    if STREAMING:
+        answer = await stream_reply(message.chat.id, responses.stream(message.from_user.id, messages))
+    else:
+        try:
+            res = await responses.invoke(message.from_user.id, messages)
+        except Exception as e:
+            if not isinstance(e, LLMUnavailable):
+                logger.exception("LLM request failed")
+            await outbox.send(message.chat.id, llm_error_text(e))
+            return
+        answer = res.content
+        await outbox.send(chat_id=message.from_user.id,
+                          text=answer)
+    if answer.strip():
+        await memory.add(message.from_user.id, message.text, answer)
+
+
+async def stream_reply(chat_id: int, chunks, edit_interval=1.5, limit=4096) -> str:
+    # Сначала отправляется заглушка, затем она редактируется по мере прихода ответа не чаще раза
+    # в edit_interval секунд. Текст длиннее лимита Telegram продолжается в следующем сообщении.
+    # Возвращает ответ целиком или пустую строку, если поток оборвался: неполный ответ не сохраняется.
+    async def edit(message_id, text):
+        try:
+            await outbox.call(bot.edit_message_text, chat_id=chat_id, message_id=message_id, text=text,
+                              parse_mode=None)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                raise
+
+    answer = ""
+    text = shown = ""
+    last_edit = time.monotonic()
+    async with ChatActionSender.typing(bot=bot, chat_id=chat_id):
+        sent = await outbox.send(chat_id, "…", parse_mode=None)
+        try:
+            # aclosing сразу закрывает поток при выходе из цикла, чтобы запрос к модели не продолжался впустую
+            async with aclosing(chunks):
+                async for chunk in chunks:
+                    answer += chunk
+                    text += chunk
+                    while len(text) > limit:
+                        cut = text.rfind("\n", 0, limit)
+                        if cut <= 0:
+                            cut = text.rfind(" ", 0, limit)
+                        if cut <= 0:
+                            cut = limit
+                        await edit(sent.message_id, text[:cut])
+                        text = text[cut:].lstrip()
+                        sent = await outbox.send(chat_id, text or "…", parse_mode=None)
+                        shown = text
+                    if text.strip() and text != shown and time.monotonic() - last_edit >= edit_interval:
+                        await edit(sent.message_id, text)
+                        shown = text
+                        last_edit = time.monotonic()
+        except Exception as e:
+            if not isinstance(e, LLMUnavailable):
+                logger.exception("LLM stream failed")
+            if not answer.strip():
+                await edit(sent.message_id, llm_error_text(e))
+            else:
+                mark = "⚠️ Ответ прерван"
+                await edit(sent.message_id, f"{text[:limit - len(mark) - 2].rstrip()}\n\n{mark}".strip())
+            return ""
+        if text.strip() and text != shown:
+            await edit(sent.message_id, text)
+    return answer
 
 
 async def start_bot():
@@ -447,77 +2331,382 @@ async def start_bot():
                 BotCommand(command='choose', description='Выбор или смена изучаемого языка'),
                 BotCommand(command='on', description='Выбрать время напоминания для изучения'),
                 BotCommand(command='off', description='Отключить напоминание'),
+                BotCommand(command='stats', description='Статистика занятий'),
                 BotCommand(command='help', description='Подсказка со всеми командами')]
     await bot.set_my_commands(commands, BotCommandScopeDefault())
 
 
+# Каждая миграция применяется один раз в своей транзакции, номер последней хранится в PRAGMA user_version.
+# Новые изменения схемы добавляются только в конец списка.
+MIGRATIONS = [
+    # 1: исходная схема
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER,
+        last_name TEXT,
+        first_name TEXT,
+        current_language TEXT,
+        current_level TEXT,
+        reminder INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS logs (
+        user_id INTEGER,
+        action TEXT,
+        text TEXT,
+        datetime TEXT
+    );
+    CREATE TABLE IF NOT EXISTS words (
+        user_id INTEGER,
+        word TEXT,
+        translation TEXT,
+        repeat INTEGER
+    );
+    ''',
+    # 2: первичные ключи для users и words (дубликаты схлопываются до последней записи) и индексы
+    '''
+    CREATE TABLE users_new (
+        id INTEGER PRIMARY KEY,
+        last_name TEXT,
+        first_name TEXT,
+        current_language TEXT,
+        current_level TEXT,
+        reminder INTEGER
+    );
+    INSERT INTO users_new (id, last_name, first_name, current_language, current_level, reminder)
+        SELECT id, last_name, first_name, current_language, current_level, reminder FROM users
+        WHERE rowid IN (SELECT MAX(rowid) FROM users WHERE id IS NOT NULL GROUP BY id);
+    DROP TABLE users;
+    ALTER TABLE users_new RENAME TO users;
+    CREATE INDEX idx_users_reminder ON users (reminder) WHERE reminder IS NOT NULL;
+
+    CREATE TABLE words_new (
+        user_id INTEGER NOT NULL,
+        word TEXT NOT NULL,
+        translation TEXT,
+        repeat INTEGER,
+        PRIMARY KEY (user_id, word)
+    );
+    INSERT INTO words_new (user_id, word, translation, repeat)
+        SELECT user_id, word, translation, repeat FROM words
+        WHERE rowid IN (SELECT MAX(rowid) FROM words WHERE user_id IS NOT NULL AND word IS NOT NULL
+                        GROUP BY user_id, word);
+    DROP TABLE words;
+    ALTER TABLE words_new RENAME TO words;
+    CREATE INDEX idx_words_user_repeat ON words (user_id, repeat, word, translation);
+
+    CREATE INDEX idx_logs_user_datetime ON logs (user_id, datetime);
+    ''',
+    # 3: дата последнего напоминания вместо пометки "час * 100"
+    '''
+    ALTER TABLE users ADD COLUMN reminder_sent TEXT;
+    UPDATE users SET reminder_sent = date('now', '+3 hours'), reminder = reminder / 100 WHERE reminder > 24;
+    ''',
+    # 4: состояния FSM
+    '''
+    CREATE TABLE fsm_states (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL DEFAULT '{}',
+        updated REAL NOT NULL
+    );
+    CREATE INDEX idx_fsm_states_updated ON fsm_states (updated);
+    ''',
+    # 5: библиотека грамматических тем и просмотренные пользователями темы
+    '''
+    CREATE TABLE topics (
+        language TEXT NOT NULL,
+        level TEXT NOT NULL,
+        topic TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created REAL NOT NULL,
+        last_used REAL NOT NULL,
+        PRIMARY KEY (language, level, topic)
+    );
+    CREATE INDEX idx_topics_last_used ON topics (language, level, last_used);
+    CREATE TABLE topics_seen (
+        user_id INTEGER NOT NULL,
+        language TEXT NOT NULL,
+        level TEXT NOT NULL,
+        topic TEXT NOT NULL,
+        PRIMARY KEY (user_id, language, level, topic)
+    );
+    ''',
+    # 6: память свободного диалога
+    '''
+    CREATE TABLE conversations (
+        user_id INTEGER PRIMARY KEY,
+        summary TEXT NOT NULL DEFAULT '',
+        turns TEXT NOT NULL DEFAULT '[]',
+        updated REAL NOT NULL
+    );
+    CREATE INDEX idx_conversations_updated ON conversations (updated);
+    ''',
+    # 7: интервальное повторение слов вместо счётчика repeat
+    '''
+    ALTER TABLE words ADD COLUMN due REAL;
+    ALTER TABLE words ADD COLUMN ease REAL NOT NULL DEFAULT 2.5;
+    ALTER TABLE words ADD COLUMN interval_days REAL NOT NULL DEFAULT 0;
+    ALTER TABLE words ADD COLUMN reps INTEGER NOT NULL DEFAULT 0;
+    UPDATE words SET due = CAST(strftime('%s', 'now') AS REAL) WHERE repeat > 0;
+    UPDATE words SET due = CAST(strftime('%s', 'now') AS REAL) + 6 * 24 * 3600, interval_days = 6, reps = 2
+        WHERE due IS NULL;
+    DROP INDEX idx_words_user_repeat;
+    CREATE INDEX idx_words_user_due ON words (user_id, due);
+    ''',
+    # 8: кэш ответов модели
+    '''
+    CREATE TABLE llm_cache (
+        key TEXT PRIMARY KEY,
+        response TEXT NOT NULL,
+        created REAL NOT NULL,
+        used REAL NOT NULL,
+        latency REAL NOT NULL
+    );
+    CREATE INDEX idx_llm_cache_used ON llm_cache (used);
+    ''',
+    # 9: дневные свёртки логов и служебные значения фоновых задач. У logs появляется свой id:
+    # rowid без INTEGER PRIMARY KEY может поменяться при VACUUM, а свёртка отслеживает по нему записи.
+    '''
+    CREATE TABLE logs_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        action TEXT,
+        text TEXT,
+        datetime TEXT
+    );
+    INSERT INTO logs_new (user_id, action, text, datetime)
+    SELECT user_id, action, text, datetime FROM logs ORDER BY rowid;
+    DROP TABLE logs;
+    ALTER TABLE logs_new RENAME TO logs;
+    CREATE INDEX idx_logs_user_datetime ON logs (user_id, datetime);
+
+    CREATE TABLE activity_daily (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        messages INTEGER NOT NULL DEFAULT 0,
+        commands INTEGER NOT NULL DEFAULT 0,
+        first_at TEXT,
+        last_at TEXT,
+        PRIMARY KEY (user_id, day)
+    ) WITHOUT ROWID;
+    CREATE TABLE maintenance (
+        key TEXT PRIMARY KEY,
+        value
+    );
+    ''',
+    # 10: отметки о просмотре удаляются вместе с вытесненными темами; оставшиеся от уже удалённых тем чистятся
+    '''
+    CREATE INDEX idx_topics_seen_topic ON topics_seen (language, level, topic);
+    DELETE FROM topics_seen WHERE NOT EXISTS (SELECT 1 FROM topics AS t WHERE t.language = topics_seen.language
+        AND t.level = topics_seen.level AND t.topic = topics_seen.topic);
+    ''',
+]
+
+
 async def start_db():
-    async with aiosqlite.connect('bot.db') as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER,
-                last_name TEXT,
-                first_name TEXT,
-                current_language TEXT,
-                current_level TEXT,
-                reminder INTEGER
-            )
-        ''')
-        await db.commit()
-
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS logs (
-                user_id INTEGER,
-                action TEXT,
-                text TEXT,
-                datetime TEXT
-            )
-        ''')
-
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS words (
-                user_id INTEGER,
-                word TEXT,
-                translation TEXT,
-                repeat INTEGER
-            )
-        ''')
-        await db.commit()
-
-
-async def send_msg(dp):
-    hours = datetime.datetime.now().hour
-
-    async with aiosqlite.connect('bot.db') as db:
-        if hours == 0:
-            async with db.execute("SELECT * FROM users WHERE reminder IS NOT NULL AND reminder > 24") as cursor:
-                async for row in cursor:
-                    await db.execute("UPDATE users SET (reminder) = (?) WHERE id = (?)", (row[5] // 100, row[0]))
-
-        async with db.execute("SELECT * FROM users WHERE reminder IS NOT NULL AND reminder < 25") as cursor:
-            async for row in cursor:
-                user_time = row[5]
-                if user_time == hours:
-                    await bot.send_message(chat_id=row[0], text='⏰ Пора изучать новые слова')
-                    await db.execute("UPDATE users SET (reminder) = (?) WHERE id = (?)", (user_time * 100, row[0]))
-        await db.commit()
+    await db.open()
+    await db.migrate(MIGRATIONS)
+    await db.enable_incremental_vacuum()
 
 
-async def main():
-    scheduler = AsyncIOScheduler(timezone='Europe/Moscow')
-    job = scheduler.add_job(send_msg, 'interval', seconds=10, args=(dp,))
-    scheduler.start()
+async def start_logs():
+    log_writer.start()
+
+
+async def start_llm():
+    await gateway.start()
+
+
+async def start_outbox():
+    await outbox.start()
+
+
+async def start_reminders():
+    await reminders.load()
+    # Догоняем рассылку текущего часа, если бот перезапускался
+    reminders.task = asyncio.create_task(reminders.dispatch())
+
+
+async def start_metrics():
+    metrics.collect("llm", lambda: {**gateway.stats, "queue_depth": gateway.queue_depth,
+                                    "in_flight": gateway.in_flight})
+    metrics.collect("outbox", lambda: outbox.stats)
+    metrics.collect("db", lambda: db.stats)
+    metrics.collect("users_cache", lambda: users.cache.stats)
+    metrics.collect("words", lambda: prefetcher.stats)
+    metrics.collect("matcher", lambda: matcher.stats)
+    metrics.collect("topics", lambda: topics.stats)
+    metrics.collect("memory", lambda: memory.stats)
+    metrics.collect("llm_cache", lambda: {**responses.stats, "hit_rate": responses.hit_rate})
+    metrics.collect("logs", lambda: log_writer.stats)
+    metrics.collect("throttling", lambda: throttling.stats)
+    metrics.collect("logs_maintenance", lambda: log_maintenance.stats)
+    await metrics.start()
+
+
+def observe_job(event):
+    # Запаздывание запуска задачи расписания относительно плановой минуты
+    name = event.job_id
+    if event.code == EVENT_JOB_SUBMITTED:
+        lag = datetime.datetime.now(TIMEZONE) - max(event.scheduled_run_times)
+        metrics.observe("bot_scheduler_lag_seconds", lag.total_seconds(), job=name)
+    elif event.code == EVENT_JOB_ERROR:
+        metrics.inc("bot_scheduler_errors_total", job=name)
+
+
+async def stop_services():
+    await metrics.stop()
+    await gateway.stop()
+    await outbox.stop()
+    await log_writer.stop()
+    await db.close()
+
+
+def setup_dispatcher(leader=True):
+    timing = TimingMiddleware()
+    dp.update.outer_middleware(timing)
+    dp.message.middleware(timing)
+    dp.callback_query.middleware(timing)
+    dp.message.outer_middleware(throttling)
+    dp.callback_query.outer_middleware(throttling)
     dp.message.outer_middleware(SomeMiddleware())
-    dp.startup.register(start_bot)
+    if METRICS:
+        dp.startup.register(start_metrics)
     dp.startup.register(start_db)
+    dp.startup.register(start_logs)
+    dp.startup.register(start_outbox)
+    dp.startup.register(start_llm)
+    # Команды меню и догоняющая рассылка напоминаний нужны только в одном процессе
+    if leader:
+        dp.startup.register(start_bot)
+        dp.startup.register(start_reminders)
+
+
+def start_scheduler() -> AsyncIOScheduler:
+    scheduler = AsyncIOScheduler(timezone=TIMEZONE)
+    scheduler.add_listener(observe_job, EVENT_JOB_SUBMITTED | EVENT_JOB_ERROR)
+    scheduler.add_job(reminders.dispatch, 'cron', minute=0, misfire_grace_time=3600, coalesce=True,
+                      id="reminders")
+    scheduler.add_job(storage.purge, 'interval', hours=1, id="fsm_purge")
+    scheduler.add_job(memory.purge, 'interval', hours=1, id="memory_purge")
+    scheduler.add_job(responses.purge, 'interval', hours=1, id="llm_cache_purge")
+    scheduler.add_job(log_maintenance.rollup, 'interval', minutes=15, id="logs_rollup")
+    scheduler.add_job(log_maintenance.run, 'cron', hour=4, minute=30, id="logs_maintenance")
+    scheduler.start()
+    return scheduler
+
+
+def share_state():
+    # Несколько процессов обслуживают одних и тех же пользователей, поэтому локальные кэши
+    # отключаются, а индекс напоминаний перечитывается из базы перед каждой рассылкой
+    storage.cache_ttl = 0
+    users.cache.ttl = 0
+    memory.cache_size = 0
+    reminders.reload = True
+    # Лимиты Telegram, число одновременных запросов к GigaChat и их бюджет в минуту заданы на весь бот,
+    # поэтому делятся между процессами: каждый держит свою долю
+    rate = outbox.bucket.rate / WORKERS
+    outbox.bucket = TokenBucket(rate, max(1.0, rate))
+    outbox.chat_rate /= WORKERS
+    outbox.chat_burst = max(1, outbox.chat_burst // WORKERS)
+    gateway.concurrency = max(1, gateway.concurrency // WORKERS)
+    # Лимиты на одного пользователя ([Throttling] и user_limit) остаются в каждом процессе своими: обновления
+    # пользователя расходятся по процессам, и поделённый лимит отсекал бы обычные сообщения
+    if gateway.budget is not None:
+        budget = gateway.budget.capacity / WORKERS
+        gateway.budget = TokenBucket(budget / 60, max(1.0, budget))
+
+
+async def main():
+    scheduler = start_scheduler()
+    setup_dispatcher()
     try:
-        print("Бот запущен")
-        await bot.delete_webhook(drop_pending_updates=True)
+        logger.info("Бот запущен")
+        await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
         await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     finally:
-        scheduler.remove_job(job.id)
+        scheduler.shutdown(wait=False)
+        await stop_services()
         await bot.session.close()
-        print("Бот остановлен")
-
-
-asyncio.run(main())
+        logger.info("Бот остановлен")
+
+
+def run_webhook(worker=0):
+    # Процесс 0 – ведущий: регистрирует вебхук и ведёт расписание, остальные только обрабатывают обновления
+    leader = worker == 0
+    if WORKERS > 1:
+        share_state()
+        # У каждого процесса свои метрики, поэтому и свой порт
+        metrics.port += worker
+    setup_dispatcher(leader)
+    handler = SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None,
+                                   handle_in_background=True)
+    app = web.Application()
+
+    async def on_startup(app: web.Application):
+        if leader:
+            await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None,
+                                  allowed_updates=dp.resolve_used_update_types(),
+                                  drop_pending_updates=DROP_PENDING_UPDATES)
+            app["scheduler"] = start_scheduler()
+        logger.info("Воркер %d запущен", worker)
+
+    async def on_shutdown(app: web.Application):
+        # Новые запросы уже не принимаются: дожидаемся начатых хендлеров, затем отправляем
+        # накопившиеся сообщения и закрываем базу. Сессию бота закрывает сам handler после этого.
+        if "scheduler" in app:
+            app["scheduler"].shutdown(wait=False)
+        tasks = set(handler._background_feed_update_tasks)
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=SHUTDOWN_TIMEOUT)
+            if pending:
+                logger.warning("Worker %d: %d handlers did not finish in time", worker, len(pending))
+        await stop_services()
+        logger.info("Воркер %d остановлен", worker)
+
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    web.run_app(app, host=HOST, port=PORT, reuse_port=WORKERS > 1, shutdown_timeout=SHUTDOWN_TIMEOUT, print=None)
+
+
+async def migrate_db():
+    database = Database(db.path, pool_size=1)
+    await database.open()
+    try:
+        await database.migrate(MIGRATIONS)
+        await database.enable_incremental_vacuum()
+    finally:
+        await database.close()
+
+
+def run_workers():
+    # Все процессы слушают один порт (SO_REUSEPORT), ядро распределяет между ними соединения Telegram.
+    # Миграции и перевод базы на incremental auto_vacuum выполняются заранее,
+    # чтобы воркеры не запускали их одновременно.
+    asyncio.run(migrate_db())
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=run_webhook, args=(worker,), name=f"worker-{worker}")
+                 for worker in range(1, WORKERS)]
+    for process in processes:
+        process.start()
+    try:
+        run_webhook(0)
+    finally:
+        # SIGTERM запускает в воркерах такое же плавное завершение, как в ведущем процессе
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    if SERVER_MODE == "webhook":
+        if WORKERS > 1:
+            run_workers()
+        else:
+            run_webhook()
+    else:
+        asyncio.run(main())
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from bench_db import load_bot_module
+
+
+@pytest.fixture(scope="session")
+def main(tmp_path_factory):
+    # main.py читает config.ini из рабочей директории, поэтому модуль загружается во временной
+    cwd = os.getcwd()
+    module = load_bot_module(str(tmp_path_factory.mktemp("bot")))
+    yield module
+    os.chdir(cwd)
@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+
+class BusyGateway:
+    # Пользователь 1 уже занял свой лимит незавершённых запросов, остальные свободны
+    model = None
+
+    def __init__(self, main):
+        self.main = main
+        self.users = []
+
+    async def check(self, user_id):
+        self.users.append(user_id)
+        await asyncio.sleep(0.05)
+        if user_id == 1:
+            raise self.main.LLMUnavailable(self.main.LLMUnavailable.BUSY)
+
+    async def invoke(self, user_id, messages):
+        await self.check(user_id)
+        return AIMessage(content="ответ")
+
+    async def stream(self, user_id, messages):
+        await self.check(user_id)
+        yield "ответ"
+
+
+async def open_cache(main, path, gateway):
+    db = main.Database(str(path / "bot.db"), pool_size=2)
+    await db.open()
+    await db.migrate(main.MIGRATIONS)
+    return db, main.ResponseCache(db, gateway)
+
+
+def test_coalesced_invoke_does_not_inherit_busy(main, tmp_path):
+    async def scenario():
+        gateway = BusyGateway(main)
+        db, cache = await open_cache(main, tmp_path, gateway)
+        messages = [HumanMessage(content="вопрос")]
+        try:
+            first = asyncio.ensure_future(cache.invoke(1, messages))
+            while not cache.in_flight:
+                await asyncio.sleep(0.001)
+            second = asyncio.ensure_future(cache.invoke(2, messages))
+            with pytest.raises(main.LLMUnavailable):
+                await first
+            assert (await second).content == "ответ"
+            assert gateway.users == [1, 2]
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_coalesced_stream_does_not_inherit_busy(main, tmp_path):
+    async def scenario():
+        gateway = BusyGateway(main)
+        db, cache = await open_cache(main, tmp_path, gateway)
+        messages = [HumanMessage(content="вопрос")]
+
+        async def collect(user_id):
+            return "".join([chunk async for chunk in cache.stream(user_id, messages)])
+
+        try:
+            first = asyncio.ensure_future(collect(1))
+            while not cache.in_flight:
+                await asyncio.sleep(0.001)
+            second = asyncio.ensure_future(collect(2))
+            with pytest.raises(main.LLMUnavailable):
+                await first
+            assert await second == "ответ"
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,84 @@
+import asyncio
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+
+class FastModel:
+    def __init__(self, steps=0):
+        self.steps = steps
+
+    async def ainvoke(self, messages):
+        for _ in range(self.steps):
+            await asyncio.sleep(0)
+        return AIMessage(content="ok")
+
+
+def test_stop_under_load_does_not_hang(main):
+    # Остановка в разные моменты, в том числе когда запрос к модели завершается одновременно с отменой
+    async def scenario():
+        for steps in range(4):
+            for spins in range(12):
+                gateway = main.LLMGateway(FastModel(steps), concurrency=4, user_limit=0)
+                await gateway.start()
+                calls = [asyncio.ensure_future(gateway.invoke(user_id, [HumanMessage(content="q")]))
+                         for user_id in range(1, 21)]
+                for _ in range(spins):
+                    await asyncio.sleep(0)
+                await asyncio.wait_for(gateway.stop(timeout=1), 2)
+                assert not gateway.workers
+                results = await asyncio.gather(*calls, return_exceptions=True)
+                assert all(isinstance(result, asyncio.CancelledError) or result.content == "ok"
+                           for result in results)
+
+    asyncio.run(scenario())
+
+
+def test_gateway_restarts_after_stop(main):
+    async def scenario():
+        gateway = main.LLMGateway(FastModel(), concurrency=2)
+        await gateway.start()
+        await gateway.stop()
+        await gateway.start()
+        try:
+            assert (await gateway.invoke(1, [HumanMessage(content="q")])).content == "ok"
+        finally:
+            await gateway.stop()
+
+    asyncio.run(scenario())
+
+
+class EndlessModel:
+    def __init__(self):
+        self.closed = asyncio.Event()
+
+    async def astream(self, messages):
+        try:
+            while True:
+                await asyncio.sleep(0.01)
+                yield AIMessage(content="слово ")
+        finally:
+            self.closed.set()
+
+
+def test_closed_stream_frees_the_slot(main, tmp_path):
+    async def scenario():
+        model = EndlessModel()
+        gateway = main.LLMGateway(model, concurrency=1, stream_timeout=5)
+        db = main.Database(str(tmp_path / "bot.db"), pool_size=1)
+        await db.open()
+        await db.migrate(main.MIGRATIONS)
+        cache = main.ResponseCache(db, gateway)
+        await gateway.start()
+        try:
+            chunks = cache.stream(1, [HumanMessage(content="q")])
+            assert await anext(chunks) == "слово "
+            await chunks.aclose()
+            await asyncio.wait_for(model.closed.wait(), 1)
+            await asyncio.sleep(0)
+            assert gateway.in_flight == 0 and len(gateway.workers) == 1 and not gateway.workers[0].done()
+            assert not gateway.outstanding
+        finally:
+            await gateway.stop()
+            await db.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,78 @@
+import asyncio
+import datetime
+import gzip
+import json
+import sqlite3
+
+
+def old_database(main, path):
+    # База до миграции 9 и без auto_vacuum, как у уже работающего бота
+    connection = sqlite3.connect(path)
+    for number, script in enumerate(main.MIGRATIONS[:8], start=1):
+        connection.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;")
+    connection.executemany("INSERT INTO logs (user_id, action, text, datetime) VALUES (?, ?, ?, ?)",
+                           [(1, "send_message", "старое", "2000-01-01 10:00:00"),
+                            (1, "use_command", "/start", "2000-01-01 11:00:00")])
+    connection.commit()
+    connection.close()
+
+
+def test_migration_and_archive_keep_watermark(main, tmp_path):
+    async def scenario():
+        path = str(tmp_path / "bot.db")
+        old_database(main, path)
+        db = main.Database(path, pool_size=2)
+        await db.open()
+        try:
+            await db.migrate(main.MIGRATIONS)
+            await db.enable_incremental_vacuum()
+            with sqlite3.connect(path) as connection:
+                assert connection.execute("PRAGMA auto_vacuum").fetchone() == (2,)
+            assert await db.fetchall("SELECT id, text FROM logs ORDER BY id") == [(1, "старое"), (2, "/start")]
+
+            maintenance = main.LogMaintenance(db, archive_dir=str(tmp_path / "archive"), retention_days=1)
+            assert await maintenance.rollup() == 2
+            # Архивируется и последняя запись: id с AUTOINCREMENT не выдаётся повторно
+            assert await maintenance.archive() == 2
+            assert await db.fetchone("SELECT COUNT(*) FROM logs") == (0,)
+            await db.executemany("INSERT INTO llm_cache VALUES (?, ?, 0, 0, 0)",
+                                 [(str(i), "x" * 4000) for i in range(100)])
+            await db.execute("DELETE FROM llm_cache")
+            await maintenance.vacuum()
+            assert await db.fetchone("PRAGMA freelist_count") == (0,)
+
+            await main.LogRepository(db).add(1, "send_message", "новое", "2000-01-02 10:00:00")
+            assert await db.fetchone("SELECT id FROM logs") == (3,)
+            assert await maintenance.rollup() == 1
+            assert await db.fetchone("SELECT messages, commands FROM activity_daily WHERE day = '2000-01-01'") \
+                == (1, 1)
+        finally:
+            await db.close()
+        with gzip.open(next((tmp_path / "archive").iterdir()), "rt", encoding="utf-8") as f:
+            assert [json.loads(line)["text"] for line in f] == ["старое", "/start"]
+
+    asyncio.run(scenario())
+
+
+def test_user_stats_counts_rolled_up_and_new_rows_once(main, tmp_path):
+    async def scenario():
+        db = main.Database(str(tmp_path / "bot.db"), pool_size=2)
+        await db.open()
+        await db.migrate(main.MIGRATIONS)
+        maintenance = main.LogMaintenance(db)
+        activity = main.ActivityRepository(db)
+        repository = main.LogRepository(db)
+        today = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            for action in ("send_message", "send_message", "use_command"):
+                await repository.add(1, action, "", today)
+            before = await activity.user_stats(1)
+            await maintenance.rollup()
+            await repository.add(1, "send_message", "", today)
+            after = await activity.user_stats(1)
+            assert (before.messages, before.commands, before.active_days) == (2, 1, 1)
+            assert (after.messages, after.commands, after.active_days, after.streak) == (3, 1, 1, 1)
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
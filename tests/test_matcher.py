@@ -0,0 +1,53 @@
+import pytest
+
+
+@pytest.fixture
+def matcher(main):
+    return main.AnswerMatcher()
+
+
+@pytest.mark.parametrize("answer, word, translation", [
+    ("кот", "cat", "кот"),
+    ("Кот.", "cat", "кот"),
+    ("ёлка", "sapin", "елка"),
+    ("собака", "dog", "собака, пёс"),
+    ("пёс", "dog", "собака, пёс"),
+    ("быть", "to be", "быть (находиться)"),
+    ("достопремечательность", "sight", "достопримечательность"),
+    ("путешествовать", "voyager", "путешествовать"),
+    ("путешествовть", "voyager", "путешествовать"),
+])
+def test_correct(matcher, main, answer, word, translation):
+    assert matcher.match(answer, word, translation) == main.AnswerMatcher.CORRECT
+
+
+@pytest.mark.parametrize("answer, word, translation", [
+    ("дочь", "nuit", "ночь"),
+    ("пить", "singen", "петь"),
+    ("брат", "prendre", "брать"),
+    ("дорога", "cher", "дорого"),
+    ("котт", "cat", "кот"),
+    ("пёсик", "dog", "собака"),
+    ("дом, кот, собака, стол, окно", "cat", "кот"),
+    ("кот или пёс", "cat", "кот"),
+    ("кот; собака", "cat", "кот"),
+    ("собака/пёс", "dog", "собака, пёс"),
+])
+def test_near_misses_and_synonyms_escalate(matcher, main, answer, word, translation):
+    assert matcher.match(answer, word, translation) == main.AnswerMatcher.UNSURE
+
+
+@pytest.mark.parametrize("answer, word, translation", [
+    ("", "cat", "кот"),
+    ("cat", "cat", "кот"),
+    ("dog", "cat", "кот"),
+])
+def test_wrong(matcher, main, answer, word, translation):
+    assert matcher.match(answer, word, translation) == main.AnswerMatcher.WRONG
+
+
+def test_stats(matcher):
+    matcher.match("кот", "cat", "кот")
+    matcher.match("дочь", "nuit", "ночь")
+    matcher.match("cat", "cat", "кот")
+    assert matcher.stats == {"correct": 1, "wrong": 1, "escalated": 1}
@@ -0,0 +1,73 @@
+import asyncio
+
+from langchain_core.messages import AIMessage
+
+
+class SlowGateway:
+    async def invoke(self, user_id, messages):
+        await asyncio.sleep(0.2)
+        return AIMessage(content="Конспект старого диалога")
+
+
+def test_clear_during_summary_does_not_restore_dialogue(main, tmp_path):
+    async def scenario():
+        db = main.Database(str(tmp_path / "bot.db"), pool_size=2)
+        await db.open()
+        await db.migrate(main.MIGRATIONS)
+        memory = main.ConversationMemory(db, SlowGateway(), max_turns=2)
+        try:
+            await memory.add(1, "первый вопрос", "первый ответ")
+            await memory.add(1, "второй вопрос", "второй ответ")
+            assert 1 in memory.summaries
+            await memory.clear(1)
+            await asyncio.sleep(0.3)
+            assert await db.fetchone("SELECT 1 FROM conversations WHERE user_id = 1") is None
+            conversation = await memory.get(1)
+            assert conversation.summary == "" and not conversation.turns
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
+
+
+class BudgetGateway:
+    def __init__(self, failures):
+        self.failures = failures
+        self.users = []
+        self.prompts = []
+
+    async def invoke(self, user_id, messages):
+        self.users.append(user_id)
+        self.prompts.append(messages[-1].content)
+        if self.failures:
+            self.failures -= 1
+            raise self.error
+        return AIMessage(content="Конспект")
+
+
+def test_failed_summary_keeps_turns(main, tmp_path):
+    async def scenario():
+        db = main.Database(str(tmp_path / "bot.db"), pool_size=2)
+        await db.open()
+        await db.migrate(main.MIGRATIONS)
+        gateway = BudgetGateway(failures=1)
+        gateway.error = main.LLMUnavailable(main.LLMUnavailable.BUDGET)
+        memory = main.ConversationMemory(db, gateway, max_turns=2, cache_size=0)
+        try:
+            await memory.add(1, "первый вопрос", "первый ответ")
+            await memory.add(1, "второй вопрос", "второй ответ")
+            await memory.summaries[1]
+            conversation = await memory.get(1)
+            assert [text for _, text in conversation.turns] == ["первый вопрос", "первый ответ",
+                                                               "второй вопрос", "второй ответ"]
+            await memory.add(1, "третий вопрос", "третий ответ")
+            await memory.summaries[1]
+            conversation = await memory.get(1)
+            assert conversation.summary == "Конспект"
+            assert [text for _, text in conversation.turns] == ["третий вопрос", "третий ответ"]
+            assert "первый вопрос" in gateway.prompts[-1] and "второй ответ" in gateway.prompts[-1]
+            assert set(gateway.users) == {main.LLMGateway.BACKGROUND_USER}
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
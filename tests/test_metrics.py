@@ -0,0 +1,35 @@
+import asyncio
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+
+class FakeModel:
+    async def ainvoke(self, messages):
+        await asyncio.sleep(0.01)
+        return AIMessage(content="ok")
+
+
+def test_llm_time_is_recorded_in_update_trace(main):
+    async def scenario():
+        gateway = main.LLMGateway(FakeModel(), concurrency=1)
+        await gateway.start()
+        try:
+            spans = []
+            token = main.metrics.trace.set(spans)
+            try:
+                await gateway.invoke(1, [HumanMessage(content="q")])
+            finally:
+                main.metrics.trace.reset(token)
+            names = [name for name, _, _ in spans]
+            assert "bot_llm_queue_seconds" in names
+            assert "bot_llm_call_seconds" in names
+        finally:
+            await gateway.stop()
+
+    asyncio.run(scenario())
+
+
+def test_handler_names_are_unique(main):
+    names = [handler.callback.__name__
+             for observer in (main.dp.message, main.dp.callback_query) for handler in observer.handlers]
+    assert len(names) == len(set(names))
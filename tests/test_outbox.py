@@ -0,0 +1,48 @@
+import asyncio
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        await asyncio.sleep(0.001)
+        self.sent.append((chat_id, text))
+        return text
+
+
+def test_stop_sends_pending_messages_in_order(main):
+    async def scenario():
+        bot = FakeBot()
+        outbox = main.Outbox(bot, rate=1000, chat_rate=1000, chat_burst=1000, workers=4)
+        await outbox.start()
+        sends = [asyncio.ensure_future(outbox.send(chat_id, str(n)))
+                 for n in range(5) for chat_id in (1, 2, 3)]
+        await asyncio.sleep(0)
+        await asyncio.wait_for(outbox.stop(timeout=5), 6)
+        assert not outbox.workers
+        assert await asyncio.gather(*sends) == [str(n) for n in range(5) for _ in (1, 2, 3)]
+        for chat_id in (1, 2, 3):
+            assert [text for chat, text in bot.sent if chat == chat_id] == [str(n) for n in range(5)]
+
+    asyncio.run(scenario())
+
+
+def test_log_writer_stop_flushes_buffer(main, tmp_path):
+    async def scenario():
+        db = main.Database(str(tmp_path / "bot.db"), pool_size=1)
+        await db.open()
+        await db.migrate(main.MIGRATIONS)
+        writer = main.LogWriter(main.LogRepository(db), batch_size=1000, flush_interval=0.01)
+        try:
+            for _ in range(20):
+                writer.start()
+                for n in range(10):
+                    writer.write(1, "send_message", str(n), "2000-01-01 10:00:00")
+                await asyncio.sleep(0.01)
+                await asyncio.wait_for(writer.stop(timeout=1), 2)
+            assert await db.fetchone("SELECT COUNT(*) FROM logs") == (200,)
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,59 @@
+import asyncio
+import datetime
+
+
+class FakeRepository:
+    def __init__(self, sent=None):
+        self.sent = sent
+        self.reminders = {}
+        self.marked = []
+
+    async def set_reminder(self, user_id, hour):
+        self.reminders[user_id] = hour
+
+    async def reminder_sent(self, user_id):
+        return self.sent
+
+    async def mark_reminders_sent(self, user_ids, date):
+        self.marked.extend(user_ids)
+
+
+class FakeOutbox:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, chat_id, text, priority=None):
+        self.sent.append(chat_id)
+
+
+def run(main, monkeypatch, repository, reload=False, hour_shift=0):
+    outbox = FakeOutbox()
+    monkeypatch.setattr(main, "outbox", outbox)
+
+    async def scenario():
+        scheduler = main.ReminderScheduler(repository)
+        scheduler.reload = reload
+        hour = (datetime.datetime.now(main.TIMEZONE).hour + hour_shift) % 24
+        await scheduler.set(1, hour)
+        await asyncio.gather(*scheduler.sending)
+        # Повторная установка того же часа не шлёт второе напоминание за день
+        await scheduler.set(1, hour)
+        await asyncio.gather(*scheduler.sending)
+
+    asyncio.run(scenario())
+    return outbox.sent
+
+
+def test_reminder_for_current_hour_is_sent_at_once(main, monkeypatch):
+    repository = FakeRepository()
+    assert run(main, monkeypatch, repository) == [1]
+    assert repository.marked == [1]
+
+
+def test_reminder_for_other_hour_waits_for_dispatch(main, monkeypatch):
+    assert run(main, monkeypatch, FakeRepository(), hour_shift=1) == []
+
+
+def test_reminder_already_sent_today_by_other_process(main, monkeypatch):
+    today = datetime.datetime.now(main.TIMEZONE).date().isoformat()
+    assert run(main, monkeypatch, FakeRepository(sent=today), reload=True) == []
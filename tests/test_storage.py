@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+from aiogram.fsm.storage.base import StorageKey
+
+
+KEY = StorageKey(bot_id=1, chat_id=2, user_id=2)
+
+
+async def open_db(main, path):
+    db = main.Database(str(path / "bot.db"), pool_size=4)
+    await db.open()
+    await db.migrate(main.MIGRATIONS)
+    return db
+
+
+def test_concurrent_state_and_data_from_two_processes(main, tmp_path):
+    async def scenario():
+        db = await open_db(main, tmp_path)
+        first = main.SQLiteStorage(db, cache_ttl=0)
+        second = main.SQLiteStorage(db, cache_ttl=0)
+        try:
+            for n in range(20):
+                await asyncio.gather(first.set_state(KEY, f"Form:step{n}"), second.set_data(KEY, {"n": n}))
+                assert await first.get_state(KEY) == f"Form:step{n}"
+                assert await second.get_data(KEY) == {"n": n}
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_expired_record_starts_over(main, tmp_path):
+    async def scenario():
+        db = await open_db(main, tmp_path)
+        storage = main.SQLiteStorage(db, state_ttl=60, cache_ttl=0)
+        try:
+            await storage.set_state(KEY, "Form:old")
+            await storage.set_data(KEY, {"old": True})
+            await db.execute("UPDATE fsm_states SET updated = ?", (time.time() - 120,))
+            await storage.set_state(KEY, "Form:new")
+            assert await storage.get_data(KEY) == {}
+            await db.execute("UPDATE fsm_states SET updated = ?", (time.time() - 120,))
+            await storage.set_data(KEY, {"new": True})
+            assert await storage.get_state(KEY) is None
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_cached_entry_follows_writes(main, tmp_path):
+    async def scenario():
+        db = await open_db(main, tmp_path)
+        storage = main.SQLiteStorage(db)
+        try:
+            await storage.set_state(KEY, "Form:name")
+            await storage.set_data(KEY, {"a": 1})
+            assert await storage.get_state(KEY) == "Form:name"
+            await storage.set_state(KEY, None)
+            assert await storage.get_state(KEY) is None
+            assert await storage.get_data(KEY) == {"a": 1}
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
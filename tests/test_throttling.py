@@ -0,0 +1,36 @@
+import asyncio
+from types import SimpleNamespace
+
+
+class FakeOutbox:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, chat_id, text):
+        self.sent.append(chat_id)
+
+
+def test_warned_users_are_pruned_with_buckets(main, monkeypatch):
+    outbox = FakeOutbox()
+    monkeypatch.setattr(main, "outbox", outbox)
+    throttling = main.ThrottlingMiddleware(rate=1000.0, burst=1, debounce=0, max_users=10)
+
+    async def handler(event, data):
+        return True
+
+    async def feed(user_id):
+        event = SimpleNamespace(chat=SimpleNamespace(id=user_id))
+        return await throttling(handler, event, {"event_from_user": SimpleNamespace(id=user_id)})
+
+    async def scenario():
+        for user_id in range(1, 6):
+            await feed(user_id)
+            await feed(user_id)
+        assert throttling.warned == {1, 2, 3, 4, 5}
+        await asyncio.sleep(0.01)
+        for user_id in range(6, 20):
+            await feed(user_id)
+        assert not throttling.warned & {1, 2, 3, 4, 5}
+        assert outbox.sent == [1, 2, 3, 4, 5]
+
+    asyncio.run(scenario())
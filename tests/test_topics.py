@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+from langchain_core.messages import AIMessage
+
+
+class SlowGateway:
+    def __init__(self, latency=0.2):
+        self.latency = latency
+        self.calls = 0
+
+    async def invoke(self, user_id, messages):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return AIMessage(content=f"Тема: Topic {self.calls}\nОбъяснение.")
+
+
+async def open_library(main, tmp_path, gateway, min_size, max_size=50):
+    db = main.Database(str(tmp_path / "bot.db"), pool_size=2)
+    await db.open()
+    await db.migrate(main.MIGRATIONS)
+    return db, main.TopicLibrary(gateway, main.TopicRepository(db), min_size=min_size, max_size=max_size)
+
+
+def test_first_miss_waits_for_one_generation_not_whole_fill(main, tmp_path):
+    async def scenario():
+        gateway = SlowGateway(0.2)
+        db, library = await open_library(main, tmp_path, gateway, min_size=10)
+        try:
+            library.refresh("en", "A")
+            started = time.perf_counter()
+            content = await library.get(1, "en", "A")
+            elapsed = time.perf_counter() - started
+            assert content.startswith("Тема: Topic")
+            assert elapsed < 0.6
+            assert gateway.calls <= 2
+        finally:
+            for task in list(library.generations.values()):
+                task.cancel()
+            await asyncio.gather(*library.generations.values(), return_exceptions=True)
+            await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_misses_share_one_generation(main, tmp_path):
+    async def scenario():
+        gateway = SlowGateway(0.1)
+        db, library = await open_library(main, tmp_path, gateway, min_size=0)
+        try:
+            first, second = await asyncio.gather(library.get(1, "en", "A"), library.get(2, "en", "A"))
+            assert first == second
+            assert gateway.calls == 1
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
+
+
+class RepeatingGateway(SlowGateway):
+    async def invoke(self, user_id, messages):
+        self.calls += 1
+        return AIMessage(content="Тема: Present Simple\nОбъяснение.")
+
+
+def test_fill_stops_when_model_repeats_topics(main, tmp_path):
+    async def scenario():
+        gateway = RepeatingGateway()
+        db, library = await open_library(main, tmp_path, gateway, min_size=5)
+        try:
+            library.refresh("en", "A")
+            await asyncio.wait_for(library.generations[("en", "A")], 2)
+            assert gateway.calls == library.max_generations == 10
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_min_size_is_clamped_to_max_size(main, tmp_path):
+    async def scenario():
+        gateway = SlowGateway(0)
+        db, library = await open_library(main, tmp_path, gateway, min_size=10, max_size=3)
+        try:
+            library.refresh("en", "A")
+            await asyncio.wait_for(library.generations[("en", "A")], 2)
+            assert library.min_size == 3 and gateway.calls == 3
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_evicted_topics_drop_seen_marks(main, tmp_path):
+    async def scenario():
+        db = main.Database(str(tmp_path / "bot.db"), pool_size=2)
+        await db.open()
+        await db.migrate(main.MIGRATIONS)
+        repository = main.TopicRepository(db)
+        try:
+            for n in range(3):
+                await repository.add("en", "A", f"topic {n}", "...", max_size=2)
+                await repository.mark_seen(1, "en", "A", f"topic {n}")
+                await asyncio.sleep(0.01)
+            await repository.add("en", "A", "topic 3", "...", max_size=2)
+            assert sorted(await repository.titles("en", "A")) == ["topic 2", "topic 3"]
+            rows = await db.fetchall("SELECT topic FROM topics_seen ORDER BY topic")
+            assert rows == [("topic 2",)]
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
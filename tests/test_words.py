@@ -0,0 +1,65 @@
+import pytest
+
+
+@pytest.mark.parametrize("line, pair", [
+    ("cat - кот", ("cat", "кот")),
+    ("1. cat – кот", ("cat", "кот")),
+    ("2) dog — собака.", ("dog", "собака")),
+    ("- house - дом", ("house", "дом")),
+    ("cat: кот", ("cat", "кот")),
+    ("cat, кот", ("cat", "кот")),
+    ("peut-être - может быть", ("peut-être", "может быть")),
+    ("well-known - известный", ("well-known", "известный")),
+    ("e-mail - электронная почта", ("e-mail", "электронная почта")),
+    ("**cat** - кот", ("cat", "кот")),
+    ("**cat** – **кот**", ("cat", "кот")),
+    ("«chat» - кошка", ("chat", "кошка")),
+    ("(gato - кот)", ("gato", "кот")),
+])
+def test_parse_pairs(main, line, pair):
+    assert main.WordPrefetcher.parse(line) == [pair]
+
+
+@pytest.mark.parametrize("line", [
+    "",
+    "Вот список слов:",
+    "peut-être",
+    "word1 - слово",
+    "cat-кот",
+])
+def test_parse_skips_garbage(main, line):
+    assert main.WordPrefetcher.parse(line) == []
+
+
+def test_parse_multiline(main):
+    content = "Конечно! Вот слова:\n1. apple - яблоко\n\n2. well-known - известный\nУдачи!"
+    assert main.WordPrefetcher.parse(content) == [("apple", "яблоко"), ("well-known", "известный")]
+
+
+class FailingGateway:
+    def __init__(self):
+        self.calls = 0
+
+    async def invoke(self, user_id, messages):
+        self.calls += 1
+        raise RuntimeError("GigaChat is down")
+
+
+class EmptyRepository:
+    async def has(self, user_id, word):
+        return False
+
+
+def test_pop_refills_once_without_final_sleep(main, monkeypatch):
+    sleeps = []
+
+    async def sleep(delay):
+        sleeps.append(delay)
+
+    monkeypatch.setattr(main.asyncio, "sleep", sleep)
+    gateway = FailingGateway()
+    prefetcher = main.WordPrefetcher(gateway, EmptyRepository(), max_attempts=3, backoff=1.0)
+    assert main.asyncio.run(prefetcher.pop(1, "en", "A")) is None
+    assert gateway.calls == 3
+    assert sleeps == [1.0, 2.0]
+    assert prefetcher.stats["refill_failures"] == 1